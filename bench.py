@@ -0,0 +1,332 @@
+"""
+Офлайн-бенчмарк бота: поднимает фейковый Bot API на localhost, направляет туда
+бота через TELEGRAM_API_URL и прогоняет через Dispatcher синтетические апдейты.
+
+    python bench.py --users 500 --latency-ms 30 --retry-rate 0.01
+    python bench.py --json > before.json   # сравнить с after.json после изменений
+
+По умолчанию лимиты отправки и анти-флуд ослаблены, чтобы мерить сам бот, а не паузы
+ради лимитов Telegram; --real-limits оставляет их как в проде.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from collections import Counter
+from datetime import datetime
+from itertools import count
+
+from aiohttp import web
+
+BENCH_TOKEN = "123456:bench-token"
+ADMIN = 1
+USER_BASE = 10_000
+
+
+# =========================
+# FAKE BOT API
+# =========================
+class FakeBotAPI:
+    """Отвечает на методы Bot API правдоподобными объектами, с задержкой и редкими 429."""
+
+    def __init__(self, latency_ms: float, jitter_ms: float, retry_rate: float, retry_after: int):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.retry_rate = retry_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.retries = 0
+        self._ids = count(1)
+        self._runner: web.AppRunner | None = None
+        self.url = ""
+
+    def _message(self, form) -> dict:
+        chat_id = int(form.get("chat_id") or form.get("from_chat_id") or 0)
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": form.get("text") or "",
+        }
+
+    def _result(self, method: str, form):
+        if method == "getMe":
+            return {"id": 42, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "copyMessage":
+            return {"message_id": next(self._ids)}
+        if method == "sendMediaGroup":
+            return [self._message(form) for _ in json.loads(form.get("media") or "[]")]
+        if method.startswith("send") or method.startswith("edit"):
+            return self._message(form)
+        return True
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        form = await request.post()
+        self.calls[method] += 1
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if method != "getMe" and random.random() < self.retry_rate:
+            self.retries += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+        return web.json_response({"ok": True, "result": self._result(method, form)})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+# =========================
+# SYNTHETIC UPDATES
+# =========================
+class UpdateFactory:
+    def __init__(self):
+        from aiogram.types import CallbackQuery, Chat, Message, PhotoSize, Update, User
+        self.CallbackQuery, self.Chat, self.Message = CallbackQuery, Chat, Message
+        self.PhotoSize, self.Update, self.User = PhotoSize, Update, User
+        self._ids = count(1)
+
+    def _user(self, uid: int):
+        return self.User(id=uid, is_bot=False, first_name=f"User {uid}", username=f"u{uid}")
+
+    def _message(self, uid: int, **kw):
+        return self.Message(
+            message_id=next(self._ids),
+            date=datetime.now(),
+            chat=self.Chat(id=uid, type="private"),
+            from_user=self._user(uid),
+            **kw,
+        )
+
+    def text(self, uid: int, text: str):
+        return self.Update(update_id=next(self._ids), message=self._message(uid, text=text))
+
+    def photo(self, uid: int, caption: str):
+        photo = [self.PhotoSize(file_id=f"ph{uid}", file_unique_id=f"u{uid}", width=640, height=480)]
+        return self.Update(update_id=next(self._ids), message=self._message(uid, photo=photo, caption=caption))
+
+    def callback(self, uid: int, data: str):
+        query = self.CallbackQuery(
+            id=str(next(self._ids)),
+            from_user=self._user(uid),
+            chat_instance="bench",
+            data=data,
+            message=self._message(uid, text="…"),
+        )
+        return self.Update(update_id=next(self._ids), callback_query=query)
+
+
+def phase_register(f: UpdateFactory, users: list[int], codes: dict) -> list:
+    return [f.text(uid, "/start") for uid in users]
+
+
+def phase_deeplink(f: UpdateFactory, users: list[int], codes: dict) -> list:
+    # каждый открывает ссылку соседа и пишет ему; каждое пятое — фото (copyMessage)
+    updates = []
+    for i, uid in enumerate(users):
+        target = users[(i + 1) % len(users)]
+        updates.append(f.text(uid, f"/start {codes[target]}"))
+        updates.append(f.photo(uid, "bench photo") if i % 5 == 0 else f.text(uid, f"hello #{i}"))
+    return updates
+
+
+def phase_burst(f: UpdateFactory, users: list[int], codes: dict, senders: int = 5, size: int = 50) -> list:
+    # несколько отправителей шлют подряд много сообщений одному получателю
+    target = users[0]
+    updates = []
+    for uid in users[1:senders + 1]:
+        updates.append(f.text(uid, f"/start {codes[target]}"))
+        for n in range(size):
+            updates.append(f.callback(uid, "ui:write_more") if n % 2 else f.text(uid, f"burst {n}"))
+    return updates
+
+
+def phase_stats(f: UpdateFactory, users: list[int], codes: dict) -> list:
+    return [f.callback(uid, "ui:stats") if i % 2 else f.text(uid, "/stats") for i, uid in enumerate(users)]
+
+
+def phase_admin(f: UpdateFactory, users: list[int], codes: dict, queries: int = 50) -> list:
+    updates = []
+    for i in range(queries):
+        uid = users[i % len(users)]
+        updates.append(f.text(ADMIN, "/admin" if i % 2 else f"/admin from:{uid}"))
+    return updates
+
+
+PHASES = {
+    "register": phase_register,
+    "deeplink": phase_deeplink,
+    "burst": phase_burst,
+    "stats": phase_stats,
+    "admin": phase_admin,
+}
+
+
+# =========================
+# RUNNER
+# =========================
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Bench:
+    def __init__(self, main, api: FakeBotAPI, rate: float):
+        self.main = main
+        self.api = api
+        self.rate = rate
+        self.submitted: dict[int, float] = {}
+        self.latencies: list[float] = []
+
+        bench = self
+
+        class Done(main.BaseMiddleware):
+            # регистрируется после ChatExecutor — значит, выполняется уже в его воркере
+            async def __call__(self, handler, event, data):
+                try:
+                    return await handler(event, data)
+                finally:
+                    t0 = bench.submitted.pop(event.update_id, None)
+                    if t0 is not None:
+                        bench.latencies.append(time.perf_counter() - t0)
+
+        main.dp.update.outer_middleware(Done())
+
+    async def _drain(self):
+        m = self.main
+        await m.executor.join()
+        while m.outbox.depth() or m.outbox.inflight:
+            await asyncio.sleep(0.01)
+        await m.write_behind.flush()
+
+    async def run_phase(self, name: str, updates: list) -> dict:
+        m = self.main
+        await self._drain()
+        self.latencies = []
+        commits0, calls0, retries0 = m.store.commits, sum(self.api.calls.values()), self.api.retries
+        interval = 1 / self.rate if self.rate else 0
+        t0 = time.perf_counter()
+        for i, update in enumerate(updates):
+            if interval:
+                delay = t0 + i * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.submitted[update.update_id] = time.perf_counter()
+            await m.dp.feed_update(m.bot, update)
+        await self._drain()
+        elapsed = time.perf_counter() - t0
+        n = len(updates)
+        return {
+            "phase": name,
+            "updates": n,
+            "seconds": round(elapsed, 3),
+            "updates_per_sec": round(n / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(percentile(self.latencies, 0.50) * 1000, 2),
+            "p99_ms": round(percentile(self.latencies, 0.99) * 1000, 2),
+            "commits_per_update": round((m.store.commits - commits0) / n, 3) if n else 0.0,
+            "api_calls_per_update": round((sum(self.api.calls.values()) - calls0) / n, 3) if n else 0.0,
+            "retry_after": self.api.retries - retries0,
+            "dropped": n - len(self.latencies),
+        }
+
+
+def print_table(results: list[dict]):
+    cols = ["phase", "updates", "seconds", "updates_per_sec", "p50_ms", "p99_ms",
+            "commits_per_update", "api_calls_per_update", "retry_after", "dropped"]
+    widths = {c: max(len(c), *(len(str(r[c])) for r in results)) for c in cols}
+    print("  ".join(c.rjust(widths[c]) for c in cols))
+    for r in results:
+        print("  ".join(str(r[c]).rjust(widths[c]) for c in cols))
+
+
+async def run(args):
+    api = FakeBotAPI(args.latency_ms, args.jitter_ms, args.retry_rate, args.retry_after)
+    await api.start()
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "ADMIN_ID": str(ADMIN),
+        "TELEGRAM_API_URL": api.url,
+        "DB_PATH": os.path.join(workdir, "bench.sqlite3"),
+        "METRICS_PORT": "0",
+        "UPDATE_MODE": "polling",
+    })
+    if not args.real_limits:
+        os.environ.update({
+            "SEND_RATE": "1000000",
+            "SEND_CHAT_RATE": "1000000",
+            "SEND_CHAT_BURST": "1000000",
+            "FLOOD_SENDER": "1000000:1000000",
+            "FLOOD_PAIR": "1000000:1000000",
+            "FLOOD_RECIPIENT": "1000000:1000000",
+        })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    bench = Bench(main, api, args.rate)
+    factory = UpdateFactory()
+    users = [USER_BASE + i for i in range(args.users)]
+    random.seed(args.seed)
+
+    await main.on_startup()
+    results = []
+    try:
+        # остальным фазам нужны зарегистрированные пользователи и их коды
+        phases = args.phases if args.phases[0] == "register" else ["register", *args.phases]
+        codes: dict[int, str] = {}
+        for name in phases:
+            results.append(await bench.run_phase(name, PHASES[name](factory, users, codes)))
+            if name == "register":
+                codes = {uid: (await main.get_user(uid))["code"] for uid in users}
+    finally:
+        await main.on_shutdown()
+        await main.bot.session.close()
+        await api.stop()
+
+    if args.json:
+        print(json.dumps({"args": vars(args), "results": results, "api_calls": dict(api.calls)}, indent=2))
+    else:
+        print_table(results)
+        print("\napi calls:", ", ".join(f"{k} {v}" for k, v in api.calls.most_common()))
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Офлайн-бенчмарк main.py на фейковом Bot API")
+    p.add_argument("--users", type=int, default=300, help="не меньше 6 — для фазы burst")
+    p.add_argument("--phases", nargs="+", choices=list(PHASES), default=list(PHASES), help="фазы по порядку")
+    p.add_argument("--rate", type=float, default=0, help="апдейтов в секунду (0 — сколько успеет)")
+    p.add_argument("--latency-ms", type=float, default=20, help="задержка ответа Bot API")
+    p.add_argument("--jitter-ms", type=float, default=5)
+    p.add_argument("--retry-rate", type=float, default=0.0, help="доля ответов 429")
+    p.add_argument("--retry-after", type=int, default=1)
+    p.add_argument("--real-limits", action="store_true", help="не ослаблять лимиты отправки и анти-флуд")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", action="store_true")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -1,17 +1,63 @@
 import os
 import re
 import time
+import asyncio
+import csv
+import gzip
+import hashlib
+import hmac
+import html
+import heapq
+import json
+import secrets
+import logging
+import signal
 import sqlite3
-from datetime import datetime
-
-from aiogram import Bot, Dispatcher, F
+import tempfile
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import suppress
+from datetime import datetime, timedelta, timezone
+from itertools import count, groupby
+from string import Formatter
+from types import MappingProxyType
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
-from aiogram.filters import CommandStart, Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.methods import (
+    CopyMessage,
+    EditMessageText,
+    SendDocument,
+    SendMediaGroup,
+    SendMessage,
+)
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import (
+    BufferedInputFile,
+    FSInputFile,
     Message,
     CallbackQuery,
+    Update,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
 )
 
 # =========================
@@ -19,33 +65,470 @@ from aiogram.types import (
 # =========================
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 ADMIN_ID = int(os.getenv("ADMIN_ID", "7489815425").strip())
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip()  # пусто — api.telegram.org
+CODE_SECRET = os.getenv("CODE_SECRET", "").strip()  # ключ кодов ссылок; по умолчанию генерируется в базе
 DB_PATH = os.getenv("DB_PATH", "bot.sqlite3")
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "90"))  # 0 — хранить логи в базе вечно
+VACUUM_CONVERT = os.getenv("VACUUM_CONVERT", "0") == "1"  # перевести старую базу на incremental auto_vacuum (полный VACUUM)
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(os.path.dirname(DB_PATH) or ".", "archive"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "5000"))
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", "3600"))
+BACKUP_DIR = os.getenv("BACKUP_DIR", os.path.join(os.path.dirname(DB_PATH) or ".", "backups"))
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL", "21600"))  # 0 — без снимков
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", "1000"))  # страниц за шаг backup API
+BACKUP_SLEEP_MS = int(os.getenv("BACKUP_SLEEP_MS", "10"))  # пауза между шагами
+CHECKPOINT_INTERVAL = int(os.getenv("CHECKPOINT_INTERVAL", "300"))
+OPTIMIZE_INTERVAL = int(os.getenv("OPTIMIZE_INTERVAL", "21600"))
+VACUUM_INTERVAL = int(os.getenv("VACUUM_INTERVAL", "3600"))
+WRITE_BEHIND_MS = int(os.getenv("WRITE_BEHIND_MS", "200"))  # как часто сбрасывать счётчики/логи
+WRITE_BEHIND_ROWS = int(os.getenv("WRITE_BEHIND_ROWS", "500"))  # или раньше, если накопилось
+BOT_ME_REFRESH = int(os.getenv("BOT_ME_REFRESH", "3600"))  # как часто перечитывать username бота
+LINK_CACHE_SIZE = int(os.getenv("LINK_CACHE_SIZE", "50000"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+KB_CACHE_SIZE = int(os.getenv("KB_CACHE_SIZE", "20000"))  # готовые персональные клавиатуры
+SEND_RATE = float(os.getenv("SEND_RATE", "30"))  # msg/s на весь бот
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))  # msg/s в один чат
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "8"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))  # сколько чатов обрабатываем одновременно
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "1000"))  # апдейтов в очереди до backpressure
+# анти-флуд, "скорость/с:запас" (запас с учётом альбомов до 10 частей)
+FLOOD_SENDER = os.getenv("FLOOD_SENDER", "1:20")
+FLOOD_PAIR = os.getenv("FLOOD_PAIR", "0.5:12")
+FLOOD_RECIPIENT = os.getenv("FLOOD_RECIPIENT", "5:50")
+ADMIN_LOG_MODE = os.getenv("ADMIN_LOG_MODE", "digest")  # digest | instant
+ADMIN_DIGEST_SECONDS = float(os.getenv("ADMIN_DIGEST_SECONDS", "10"))
+ADMIN_DIGEST_MAX_ENTRIES = int(os.getenv("ADMIN_DIGEST_MAX_ENTRIES", "50"))
+ADMIN_DIGEST_MAX_MESSAGES = int(os.getenv("ADMIN_DIGEST_MAX_MESSAGES", "3"))  # больше — шлём файлом
+ADMIN_ENTRY_MAX_CHARS = 1000
+ALBUM_DEBOUNCE_MS = int(os.getenv("ALBUM_DEBOUNCE_MS", "800"))  # ждём остальные части альбома
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))  # msg/s, оставляем запас под обычный трафик
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "200"))
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "2000"))  # строк за один запрос при /export
+ADMIN_PAGE_SIZE = 25
+ADMIN_PAGE_TEXT_CHARS = 120
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is empty. Set Railway variable BOT_TOKEN")
 
-bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling").strip()  # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()  # публичный адрес, например https://app.up.railway.app
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# по умолчанию выводится из токена — не меняется между рестартами
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+WEBHOOK_DELETE_ON_SHUTDOWN = os.getenv("WEBHOOK_DELETE_ON_SHUTDOWN", "0") == "1"
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("PORT", "8080"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # 0 — не поднимать /metrics
+
+if UPDATE_MODE == "webhook" and not WEBHOOK_URL:
+    raise RuntimeError("UPDATE_MODE=webhook requires WEBHOOK_URL")
+
+log = logging.getLogger("bot")
+
+# свой сервер Bot API (локальный telegram-bot-api или фейковый из bench.py)
+_api_session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(BOT_TOKEN, session=_api_session, default=DefaultBotProperties(parse_mode="HTML"))
 dp = Dispatcher()
 
 TTL_SECONDS = 15 * 60  # окно на отправку после открытия ссылки
+PENDING_PERSIST = os.getenv("PENDING_PERSIST", "1") == "1"  # сохранять pending в базу на случай рестарта
+PENDING_PURGE_SECONDS = int(os.getenv("PENDING_PURGE_SECONDS", "60"))
+
+
+# =========================
+# METRICS
+# =========================
+# Границы бакетов гистограмм, секунды
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами, как в Prometheus."""
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)  # последний — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(METRIC_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля линейной интерполяцией внутри бакета."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lo = METRIC_BUCKETS[i - 1] if i else 0.0
+                if i == len(METRIC_BUCKETS):
+                    return lo  # за последней границей точнее не оценить
+                return lo + (METRIC_BUCKETS[i] - lo) * (rank - seen) / n
+            seen += n
+        return METRIC_BUCKETS[-1]
+
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _metric_value(value) -> str:
+    # без :g — там 6 значащих цифр, и счётчики больше 10**6 росли бы ступеньками
+    return repr(value) if isinstance(value, float) else str(int(value))
+
+
+class Metrics:
+    """
+    Счётчики и гистограммы в памяти процесса, отдаются в текстовом формате Prometheus.
+    Пишут и event loop, и потоки БД — поэтому под локом.
+    Значения, которые уже считают сами компоненты (кэши, очереди), не дублируются:
+    они снимаются колбэками в момент отдачи.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._meta: dict[str, tuple[str, str, tuple[str, ...]]] = {}  # name -> (type, help, labels)
+        self._counters: dict[str, dict[tuple, float]] = {}
+        self._histograms: dict[str, dict[tuple, Histogram]] = {}
+        self._collectors: list[tuple[str, str, str, str | None, object]] = []
+
+    def counter(self, name: str, help_text: str, *labels: str):
+        self._meta[name] = ("counter", help_text, labels)
+        self._counters[name] = {}
+
+    def histogram(self, name: str, help_text: str, *labels: str):
+        self._meta[name] = ("histogram", help_text, labels)
+        self._histograms[name] = {}
+
+    def collect(self, name: str, kind: str, help_text: str, fn, label: str | None = None):
+        """fn() -> число, или dict {значение метки: число}, если задан label."""
+        self._collectors.append((name, kind, help_text, label, fn))
+
+    def inc(self, name: str, *labels, value: float = 1):
+        with self._lock:
+            series = self._counters[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, value: float, *labels):
+        with self._lock:
+            series = self._histograms[name]
+            h = series.get(labels)
+            if h is None:
+                h = series[labels] = Histogram()
+            h.observe(value)
+
+    def counters(self, name: str) -> dict[tuple, float]:
+        with self._lock:
+            return dict(self._counters[name])
+
+    def histograms(self, name: str) -> dict[tuple, Histogram]:
+        """Копии гистограмм — их можно читать без лока."""
+        with self._lock:
+            result = {}
+            for labels, h in self._histograms[name].items():
+                c = Histogram()
+                c.counts, c.sum, c.count = list(h.counts), h.sum, h.count
+                result[labels] = c
+            return result
+
+    @staticmethod
+    def _labels(names, values, extra: str = "") -> str:
+        parts = [f'{n}="{_label_value(v)}"' for n, v in zip(names, values)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        out = []
+        for name, (kind, help_text, names) in self._meta.items():
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for values, v in sorted(self.counters(name).items()):
+                    out.append(f"{name}{self._labels(names, values)} {_metric_value(v)}")
+                continue
+            for values, h in sorted(self.histograms(name).items()):
+                cumulative = 0
+                for bound, n in zip(METRIC_BUCKETS + ("+Inf",), h.counts):
+                    cumulative += n
+                    le = f'le="{bound}"'
+                    out.append(f"{name}_bucket{self._labels(names, values, le)} {cumulative}")
+                out.append(f"{name}_sum{self._labels(names, values)} {h.sum:.6f}")
+                out.append(f"{name}_count{self._labels(names, values)} {h.count}")
+        for name, kind, help_text, label, fn in self._collectors:
+            try:
+                value = fn()
+            except Exception:
+                log.exception("metrics: collector %s failed", name)
+                continue
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            if label is None:
+                out.append(f"{name} {_metric_value(value)}")
+            else:
+                for k, v in sorted(value.items()):
+                    out.append(f'{name}{{{label}="{_label_value(k)}"}} {_metric_value(v)}')
+        out.append("")
+        return "\n".join(out)
+
+
+metrics = Metrics()
+metrics.counter("bot_updates_total", "Incoming updates by type", "type", "content")
+metrics.histogram("bot_handler_seconds", "Handler latency", "handler")
+metrics.counter("bot_handler_errors_total", "Handler exceptions", "handler")
+metrics.histogram("bot_api_seconds", "Bot API request latency", "method")
+metrics.counter("bot_api_errors_total", "Bot API request errors", "method", "error")
+metrics.histogram("bot_db_seconds", "SQLite call time inside the DB thread", "op", "query")
+metrics.histogram("bot_maintenance_seconds", "DB maintenance job duration", "job")
+metrics.counter("bot_maintenance_errors_total", "DB maintenance job failures", "job")
+
+
+class UpdateCounter(BaseMiddleware):
+    async def __call__(self, handler, event: Update, data):
+        content = event.message.content_type.value if event.message is not None else ""
+        metrics.inc("bot_updates_total", event.event_type, content)
+        return await handler(event, data)
+
+
+class HandlerTiming(BaseMiddleware):
+    """Inner-middleware: время конкретного хендлера, без фильтров и очереди."""
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", name)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - t0, name)
+
+
+class ApiTiming(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc("bot_api_errors_total", name, type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_api_seconds", time.perf_counter() - t0, name)
+
+
+# UpdateCounter регистрируется первым — считает и то, что потом отбросит анти-флуд
+dp.update.outer_middleware(UpdateCounter())
+dp.message.middleware(HandlerTiming())
+dp.callback_query.middleware(HandlerTiming())
+bot.session.middleware(ApiTiming())
+
+
+class MetricsServer:
+    """Отдельный локальный HTTP только с /metrics — наружу его не публикуем."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._runner: web.AppRunner | None = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self):
+        if not self.port or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        log.info("metrics: http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT)
+
+
+# =========================
+# CACHE
+# =========================
+class LRUCache:
+    """Ограниченный по размеру LRU-словарь со счётчиками попаданий/промахов."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
 
 
 # =========================
 # DB
 # =========================
-def db() -> sqlite3.Connection:
-    con = sqlite3.connect(DB_PATH)
-    con.row_factory = sqlite3.Row
-    return con
+_SQL_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", re.IGNORECASE)
+
+
+def _sql_name(sql: str) -> str:
+    """Метка для ad-hoc запросов: «select:users» — без параметров, чтобы не плодить серии."""
+    verb = sql.split(None, 1)[0].lower()
+    m = _SQL_TABLE_RE.search(sql)
+    return f"{verb}:{m.group(1)}" if m else verb
+
+
+class Storage:
+    """
+    Долгоживущие соединения SQLite: один писатель + пул читателей (WAL).
+    Все запросы выполняются в потоках, event loop не блокируется.
+    """
+
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self.readers = max(1, readers)
+        self._writer: sqlite3.Connection | None = None
+        self._writer_pool: ThreadPoolExecutor | None = None
+        self._reader_pool: ThreadPoolExecutor | None = None
+        self._reader_cons: list[sqlite3.Connection] = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.commits = 0  # только из потока писателя
+
+    def _connect(self, readonly: bool = False) -> sqlite3.Connection:
+        con = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        con.row_factory = sqlite3.Row
+        con.execute("PRAGMA busy_timeout=5000")
+        if readonly:
+            con.execute("PRAGMA query_only=1")
+        return con
+
+    def _init_reader(self):
+        con = self._connect(readonly=True)
+        self._local.con = con
+        with self._lock:
+            self._reader_cons.append(con)
+
+    def open(self):
+        if self._writer is not None:
+            return
+        self._writer = self._connect()
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+        # после checkpoint WAL-файл обрезается до этого размера, а не остаётся на пике
+        self._writer.execute("PRAGMA journal_size_limit=67108864")
+        self._writer_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._reader_pool = ThreadPoolExecutor(
+            max_workers=self.readers,
+            thread_name_prefix="db-reader",
+            initializer=self._init_reader,
+        )
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._reader_pool.shutdown(wait=True)
+        self._writer_pool.shutdown(wait=True)
+        for con in self._reader_cons:
+            con.close()
+        self._reader_cons.clear()
+        self._writer.close()
+        self._writer = None
+
+    def _run_read(self, fn, args, name):
+        t0 = time.perf_counter()
+        try:
+            return fn(self._local.con, *args)
+        finally:
+            metrics.observe("bot_db_seconds", time.perf_counter() - t0, "read", name)
+
+    def _run_write(self, fn, args, name):
+        con = self._writer
+        t0 = time.perf_counter()
+        try:
+            result = fn(con, *args)
+            con.commit()
+            self.commits += 1
+            return result
+        except BaseException:
+            con.rollback()
+            raise
+        finally:
+            metrics.observe("bot_db_seconds", time.perf_counter() - t0, "write", name)
+
+    async def read(self, fn, *args, name: str | None = None):
+        """fn(con, *args) на соединении-читателе. name — метка в метриках (по умолчанию имя fn)."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._reader_pool, self._run_read, fn, args, name or fn.__name__)
+
+    async def write(self, fn, *args, name: str | None = None):
+        """fn(con, *args) на соединении-писателе в одной транзакции."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer_pool, self._run_write, fn, args, name or fn.__name__)
+
+    async def fetchone(self, sql: str, params=()):
+        return await self.read(lambda con: con.execute(sql, params).fetchone(), name=_sql_name(sql))
+
+    async def fetchall(self, sql: str, params=()):
+        return await self.read(lambda con: con.execute(sql, params).fetchall(), name=_sql_name(sql))
+
+    async def execute(self, sql: str, params=()):
+        await self.write(lambda con: con.execute(sql, params), name=_sql_name(sql))
+
+
+store = Storage(DB_PATH, readers=DB_READERS)
 
 
 def today_key() -> str:
     return datetime.utcnow().strftime("%Y-%m-%d")
 
 
-def init_db():
-    with db() as con:
-        con.execute("""
+# =========================
+# MIGRATIONS
+# =========================
+# (версия, описание, шаги). Шаг — SQL-строка или функция f(con).
+# Новые миграции только добавляются в конец, старые не редактируются.
+MIGRATIONS = [
+    (1, "base schema", [
+        """
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -53,25 +536,25 @@ def init_db():
             code TEXT UNIQUE,
             lang TEXT DEFAULT 'ru',
             created_at INTEGER
-        );
-        """)
-        con.execute("""
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS pending (
             from_id INTEGER PRIMARY KEY,
             to_id INTEGER NOT NULL,
             created_at INTEGER NOT NULL
-        );
-        """)
-        con.execute("""
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS logs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             from_id INTEGER NOT NULL,
             to_id INTEGER NOT NULL,
             text TEXT NOT NULL,
             created_at INTEGER NOT NULL
-        );
-        """)
-        con.execute("""
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS stats (
             user_id INTEGER PRIMARY KEY,
             link_clicks_total INTEGER DEFAULT 0,
@@ -79,137 +562,1593 @@ def init_db():
             msgs_total INTEGER DEFAULT 0,
             msgs_today INTEGER DEFAULT 0,
             last_day TEXT DEFAULT ''
-        );
-        """)
-        con.commit()
+        )
+        """,
+    ]),
+    (2, "indexes for logs and pending", [
+        "CREATE INDEX IF NOT EXISTS idx_logs_created_at ON logs(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_logs_to_id ON logs(to_id)",
+        "CREATE INDEX IF NOT EXISTS idx_pending_created_at ON pending(created_at)",
+    ]),
+    # rowid входит в любой индекс, так что (to_id) уже работает как (to_id, id)
+    (3, "index logs by sender", [
+        "CREATE INDEX IF NOT EXISTS idx_logs_from_id ON logs(from_id)",
+    ]),
+    (4, "incremental auto_vacuum", [
+        lambda con: _enable_incremental_vacuum(con),
+    ]),
+    # счётчики по дням + итоги вместо stats с обнулением «сегодня»;
+    # старая таблица stats остаётся как есть (в неё больше не пишем)
+    (5, "daily stats rollup", [
+        """
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            link_clicks INTEGER NOT NULL DEFAULT 0,
+            msgs INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            user_id INTEGER PRIMARY KEY,
+            link_clicks INTEGER NOT NULL DEFAULT 0,
+            msgs INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "INSERT OR IGNORE INTO stats_totals (user_id, link_clicks, msgs) "
+        "SELECT user_id, link_clicks_total, msgs_total FROM stats",
+        "INSERT OR IGNORE INTO stats_daily (user_id, day, link_clicks, msgs) "
+        "SELECT user_id, last_day, link_clicks_today, msgs_today FROM stats "
+        "WHERE last_day<>'' AND (link_clicks_today>0 OR msgs_today>0)",
+    ]),
+    (6, "broadcasts", [
+        "ALTER TABLE users ADD COLUMN blocked_at INTEGER",
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT,
+            from_chat_id INTEGER,
+            message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            status_chat_id INTEGER,
+            status_message_id INTEGER,
+            created_at INTEGER NOT NULL,
+            finished_at INTEGER
+        )
+        """,
+    ]),
+    (7, "meta + code secret", [
+        """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        """,
+        lambda con: _create_code_secret(con),
+    ]),
+    (8, "full-text index for logs", [
+        # external content: текст хранится только в logs, индекс держат триггеры
+        # (в том числе на удаление — его делает архивация)
+        "CREATE VIRTUAL TABLE IF NOT EXISTS logs_fts USING fts5("
+        "text, content='logs', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        """
+        CREATE TRIGGER IF NOT EXISTS logs_fts_ai AFTER INSERT ON logs BEGIN
+            INSERT INTO logs_fts (rowid, text) VALUES (new.id, new.text);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS logs_fts_ad AFTER DELETE ON logs BEGIN
+            INSERT INTO logs_fts (logs_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS logs_fts_au AFTER UPDATE OF text ON logs BEGIN
+            INSERT INTO logs_fts (logs_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO logs_fts (rowid, text) VALUES (new.id, new.text);
+        END
+        """,
+        "INSERT INTO logs_fts (logs_fts) VALUES ('rebuild')",
+    ]),
+]
+
+
+def _convert_auto_vacuum(con: sqlite3.Connection):
+    # auto_vacuum меняется только через VACUUM, а он не работает внутри транзакции.
+    # VACUUM переписывает весь файл: бот стоит, пока он идёт, и на диске нужно ещё столько же места
+    if con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    log.info("converting database to incremental auto_vacuum (full VACUUM)")
+    con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    con.execute("VACUUM")
+
+
+def _enable_incremental_vacuum(con: sqlite3.Connection):
+    # новую базу переводим сразу — VACUUM пустого файла мгновенный; базу с данными — только с VACUUM_CONVERT=1
+    if con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    fresh = not con.execute("SELECT EXISTS (SELECT 1 FROM users) OR EXISTS (SELECT 1 FROM logs)").fetchone()[0]
+    if not (fresh or VACUUM_CONVERT):
+        log.warning("auto_vacuum is not incremental: freed pages stay in the file until VACUUM_CONVERT=1")
+        return
+    con.commit()
+    _convert_auto_vacuum(con)
+    con.execute("BEGIN IMMEDIATE")
 
 
-def _gen_code(n: int = 10) -> str:
-    alphabet = "abcdefghijklmnopqrstuvwxyz0123456789"
-    import random
-    return "".join(random.choice(alphabet) for _ in range(n))
+def _create_code_secret(con: sqlite3.Connection):
+    con.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('code_secret', ?)", (secrets.token_hex(32),))
 
 
-def upsert_user(user_id: int, username: str, full_name: str) -> str:
-    with db() as con:
-        row = con.execute("SELECT code FROM users WHERE user_id=?", (user_id,)).fetchone()
-        if row:
+def schema_version(con: sqlite3.Connection) -> int:
+    row = con.execute("SELECT MAX(version) AS v FROM schema_version").fetchone()
+    return row["v"] or 0
+
+
+def migrate(con: sqlite3.Connection) -> list[int]:
+    """Применяет недостающие миграции, каждую в своей транзакции. Возвращает применённые версии."""
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at INTEGER NOT NULL
+    )
+    """)
+    con.commit()
+    applied = []
+    for version, name, steps in MIGRATIONS:
+        if version <= schema_version(con):
+            continue
+        # IMMEDIATE: если стартуют несколько воркеров, миграцию применит один
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= schema_version(con):
+                con.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(con)
+                else:
+                    con.execute(step)
+            # шаг с VACUUM коммитит и заново берёт блокировку — за это время
+            # миграцию мог применить другой воркер
+            if version <= schema_version(con):
+                con.rollback()
+                continue
             con.execute(
-                "UPDATE users SET username=?, full_name=? WHERE user_id=?",
-                (username, full_name, user_id),
+                "INSERT INTO schema_version (version, name, applied_at) VALUES (?,?,?)",
+                (version, name, int(time.time())),
             )
             con.commit()
-            return row["code"]
+        except BaseException:
+            con.rollback()
+            raise
+        applied.append(version)
+        log.info("migration %s applied: %s", version, name)
+    return applied
+
+
+async def init_db():
+    await store.write(migrate)
+    if VACUUM_CONVERT:
+        # миграция 4 на старой базе могла пройти без перевода
+        await store.write(_convert_auto_vacuum)
+    code_codec.set_key((CODE_SECRET or await store.read(_load_code_secret)).encode())
+
+
+class CodeCodec:
+    """
+    user_id <-> код ссылки без запросов к базе: ключевая перестановка Фейстеля
+    на 64 битах (раунды — HMAC-SHA256) и base36 фиксированной длины.
+    Перестановка биективна, поэтому коды разных пользователей не совпадают,
+    а без ключа их нельзя ни перебрать по порядку, ни связать с user_id.
+    """
+
+    LENGTH = 13  # 36**13 > 2**64
+    ROUNDS = 4
+    ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+    _MASK = 0xFFFFFFFF
+
+    def __init__(self):
+        self._key: bytes | None = None
+
+    def set_key(self, key: bytes):
+        self._key = key
+
+    def _f(self, rnd: int, half: int) -> int:
+        digest = hmac.new(self._key, bytes((rnd,)) + half.to_bytes(4, "big"), hashlib.sha256).digest()
+        return int.from_bytes(digest[:4], "big")
+
+    def encode(self, user_id: int) -> str:
+        if not 0 <= user_id < 1 << 64:
+            raise ValueError(f"user_id out of range: {user_id}")
+        left, right = user_id >> 32, user_id & self._MASK
+        for rnd in range(self.ROUNDS):
+            left, right = right, left ^ self._f(rnd, right)
+        n = left << 32 | right
+        chars = []
+        for _ in range(self.LENGTH):
+            n, r = divmod(n, 36)
+            chars.append(self.ALPHABET[r])
+        return "".join(reversed(chars))
+
+    def decode(self, code: str) -> int | None:
+        """user_id, если code похож на код этого формата; совпадение с базой проверяет вызывающий."""
+        if len(code) != self.LENGTH or not code.isalnum() or not code.isascii():
+            return None
+        n = int(code, 36)
+        if n >> 64:
+            return None
+        left, right = n >> 32, n & self._MASK
+        for rnd in reversed(range(self.ROUNDS)):
+            left, right = right ^ self._f(rnd, left), left
+        return left << 32 | right
+
+
+code_codec = CodeCodec()
+
+
+def _load_code_secret(con: sqlite3.Connection) -> str:
+    return con.execute("SELECT value FROM meta WHERE key='code_secret'").fetchone()["value"]
+
+
+def _upsert_user(con: sqlite3.Connection, user_id: int, username: str, full_name: str) -> dict:
+    row = con.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
+    if row:
+        # пользователь снова пишет боту — значит, больше не заблокирован
+        con.execute(
+            "UPDATE users SET username=?, full_name=?, blocked_at=NULL WHERE user_id=?",
+            (username, full_name, user_id),
+        )
+        return {**dict(row), "username": username, "full_name": full_name, "blocked_at": None}
 
+    code = code_codec.encode(user_id)
+    created_at = int(time.time())
+    con.execute(
+        "INSERT INTO users (user_id, username, full_name, code, created_at) VALUES (?,?,?,?,?)",
+        (user_id, username, full_name, code, created_at),
+    )
+    return {
+        "user_id": user_id,
+        "username": username,
+        "full_name": full_name,
+        "code": code,
+        "lang": "ru",
+        "created_at": created_at,
+        "blocked_at": None,
+    }
+
+
+# кэш строк users: user_id -> dict, code -> user_id.
+# Закэшированные dict не меняем на месте — только заменяем целиком.
+user_cache = LRUCache(USER_CACHE_SIZE)
+code_cache = LRUCache(USER_CACHE_SIZE)
+
+
+def _cache_user(u: dict) -> dict:
+    user_cache.put(u["user_id"], u)
+    code_cache.put(u["code"], u["user_id"])
+    return u
+
+
+async def upsert_user(user_id: int, username: str, full_name: str) -> str:
+    u = user_cache.get(user_id)
+    if (u is not None and u["username"] == username and u["full_name"] == full_name
+            and u["blocked_at"] is None):
+        return u["code"]
+    u = await store.write(_upsert_user, user_id, username, full_name)
+    return _cache_user(u)["code"]
+
+
+async def get_user(user_id: int) -> dict | None:
+    u = user_cache.get(user_id)
+    if u is not None:
+        return u
+    row = await store.fetchone("SELECT * FROM users WHERE user_id=?", (user_id,))
+    return _cache_user(dict(row)) if row else None
+
+
+async def get_user_by_code(code: str) -> dict | None:
+    # новые коды раскодируются в user_id и ищутся по первичному ключу;
+    # старые 10-символьные (и коды, выданные до смены ключа) — по индексу code
+    user_id = code_cache.get(code)
+    if user_id is None:
+        user_id = code_codec.decode(code)
+    if user_id is not None:
+        u = await get_user(user_id)
+        if u is not None and u["code"] == code:
+            return u
+    row = await store.fetchone("SELECT * FROM users WHERE code=?", (code,))
+    return _cache_user(dict(row)) if row else None
+
+
+def _flush_batch(con: sqlite3.Connection, counters: dict[tuple[int, str], list[int]], rows: list[tuple[str, tuple]]):
+    if counters:
+        con.executemany(
+            "INSERT INTO stats_daily (user_id, day, link_clicks, msgs) VALUES (?,?,?,?) "
+            "ON CONFLICT(user_id, day) DO UPDATE SET "
+            "link_clicks=link_clicks+excluded.link_clicks, msgs=msgs+excluded.msgs",
+            [(uid, day, c, m) for (uid, day), (c, m) in counters.items()],
+        )
+        totals: dict[int, list[int]] = {}
+        for (uid, _), (c, m) in counters.items():
+            tot = totals.setdefault(uid, [0, 0])
+            tot[0] += c
+            tot[1] += m
+        con.executemany(
+            "INSERT INTO stats_totals (user_id, link_clicks, msgs) VALUES (?,?,?) "
+            "ON CONFLICT(user_id) DO UPDATE SET "
+            "link_clicks=link_clicks+excluded.link_clicks, msgs=msgs+excluded.msgs",
+            [(uid, c, m) for uid, (c, m) in totals.items()],
+        )
+    # подряд идущие одинаковые запросы — одним executemany, порядок сохраняется
+    for sql, group in groupby(rows, key=lambda r: r[0]):
+        con.executemany(sql, [params for _, params in group])
+
+
+class WriteBehind:
+    """
+    Копит инкременты счётчиков и строки логов в памяти и сбрасывает их
+    одной транзакцией раз в interval_ms или при накоплении max_rows.
+    """
+
+    def __init__(self, storage: Storage, interval_ms: int = 200, max_rows: int = 500):
+        self.storage = storage
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self._counters: dict[tuple[int, str], list[int]] = {}  # (user_id, day) -> [clicks, msgs]
+        self._rows: list[tuple[str, tuple]] = []
+        self._size = 0
+        self._full = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self.flushes = 0
+        self.flushed = 0
+
+    def _added(self):
+        self._size += 1
+        if self._size >= self.max_rows:
+            self._full.set()
+
+    def incr(self, user_id: int, clicks: int = 0, msgs: int = 0):
+        # день фиксируем в момент события, а не сброса — иначе клик в 23:59:59 уедет в завтра
+        c = self._counters.setdefault((user_id, today_key()), [0, 0])
+        c[0] += clicks
+        c[1] += msgs
+        self._added()
+
+    def add(self, sql: str, params: tuple):
+        self._rows.append((sql, params))
+        self._added()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._size:
+                return
+            counters, rows, size = self._counters, self._rows, self._size
+            self._counters, self._rows, self._size = {}, [], 0
+            self._full.clear()
+            try:
+                await self.storage.write(_flush_batch, counters, rows)
+            except Exception:
+                self._restore(counters, rows, size)
+                raise
+            self.flushes += 1
+            self.flushed += size
+
+    def _restore(self, counters: dict[tuple[int, str], list[int]], rows: list[tuple[str, tuple]], size: int):
+        # транзакция откатилась — возвращаем пачку в буфер до следующего сброса;
+        # строки — в начало, чтобы не нарушить порядок
+        for key, (clicks, msgs) in counters.items():
+            c = self._counters.setdefault(key, [0, 0])
+            c[0] += clicks
+            c[1] += msgs
+        self._rows[:0] = rows
+        self._size += size
+        if self._size >= self.max_rows:
+            self._full.set()
+
+    def stats(self) -> dict:
+        return {"buffered": self._size, "flushes": self.flushes, "flushed": self.flushed}
+
+    async def _run(self):
         while True:
-            code = _gen_code(10)
-            exists = con.execute("SELECT 1 FROM users WHERE code=?", (code,)).fetchone()
-            if not exists:
-                break
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("write-behind flush failed")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        # последний сброс перед выходом: при временной ошибке (SQLITE_BUSY) пробуем ещё
+        for attempt in range(3):
+            try:
+                await self.flush()
+                return
+            except Exception:
+                log.exception("write-behind final flush failed (attempt %s)", attempt + 1)
+                await asyncio.sleep(1)
+
+
+write_behind = WriteBehind(store, interval_ms=WRITE_BEHIND_MS, max_rows=WRITE_BEHIND_ROWS)
+
+
+async def inc_click(user_id: int):
+    write_behind.incr(user_id, clicks=1)
+
+
+async def inc_msg(user_id: int):
+    write_behind.incr(user_id, msgs=1)
+
+
+def _get_stats(con: sqlite3.Connection, user_id: int, since: str) -> tuple:
+    days = con.execute(
+        "SELECT day, link_clicks, msgs FROM stats_daily WHERE user_id=? AND day>=? ORDER BY day",
+        (user_id, since),
+    ).fetchall()
+    totals = con.execute("SELECT link_clicks, msgs FROM stats_totals WHERE user_id=?", (user_id,)).fetchone()
+    return days, totals
+
+
+async def get_stats(user_id: int) -> dict:
+    """Сегодня, 7 и 30 дней (из stats_daily), всё время (stats_totals) и ряд за 7 дней по дням."""
+    await write_behind.flush()
+    today = datetime.utcnow().date()
+    last30 = [(today - timedelta(days=i)).isoformat() for i in range(29, -1, -1)]
+    days, totals = await store.read(_get_stats, user_id, last30[0])
+    by_day = {r["day"]: (r["link_clicks"], r["msgs"]) for r in days}
+    series = [(d, *by_day.get(d, (0, 0))) for d in last30]  # (day, clicks, msgs)
+    return {
+        "user_id": user_id,
+        "link_clicks_today": series[-1][1],
+        "msgs_today": series[-1][2],
+        "link_clicks_7d": sum(c for _, c, _ in series[-7:]),
+        "msgs_7d": sum(m for _, _, m in series[-7:]),
+        "link_clicks_30d": sum(c for _, c, _ in series),
+        "msgs_30d": sum(m for _, _, m in series),
+        "link_clicks_total": totals["link_clicks"] if totals else 0,
+        "msgs_total": totals["msgs"] if totals else 0,
+        "series_7d": series[-7:],
+    }
+
+
+class PendingStore:
+    """
+    «Кто кому сейчас пишет» — в памяти: dict + куча сроков истечения.
+    Таблица pending нужна только чтобы пережить рестарт (persist=True),
+    пишем в неё через write-behind, читаем один раз при старте.
+    """
+
+    def __init__(self, ttl: int, persist: bool = True, purge_interval: int = 60):
+        self.ttl = ttl
+        self.persist = persist
+        self.purge_interval = purge_interval
+        self._items: dict[int, tuple[int, int]] = {}  # from_id -> (to_id, created_at)
+        self._heap: list[tuple[int, int]] = []  # (expires_at, from_id), устаревшие записи пропускаем
+        self._task: asyncio.Task | None = None
+
+    def set(self, from_id: int, to_id: int):
+        now = int(time.time())
+        self._items[from_id] = (to_id, now)
+        heapq.heappush(self._heap, (now + self.ttl, from_id))
+        if self.persist:
+            write_behind.add(
+                "INSERT OR REPLACE INTO pending (from_id, to_id, created_at) VALUES (?,?,?)",
+                (from_id, to_id, now),
+            )
 
-        con.execute(
-            "INSERT INTO users (user_id, username, full_name, code, created_at) VALUES (?,?,?,?,?)",
-            (user_id, username, full_name, code, int(time.time())),
-        )
-        con.commit()
-        return code
+    def get(self, from_id: int) -> dict | None:
+        item = self._items.get(from_id)
+        if item is None:
+            return None
+        return {"from_id": from_id, "to_id": item[0], "created_at": item[1]}
+
+    def clear(self, from_id: int):
+        if self._items.pop(from_id, None) is not None and self.persist:
+            write_behind.add("DELETE FROM pending WHERE from_id=?", (from_id,))
+
+    def purge(self) -> int:
+        now = int(time.time())
+        removed = 0
+        while self._heap and self._heap[0][0] <= now:
+            _, from_id = heapq.heappop(self._heap)
+            item = self._items.get(from_id)
+            if item is not None and item[1] + self.ttl <= now:
+                del self._items[from_id]
+                removed += 1
+        if removed and self.persist:
+            write_behind.add("DELETE FROM pending WHERE created_at<=?", (now - self.ttl,))
+        return removed
+
+    async def load(self):
+        if not self.persist:
+            return
+        cutoff = int(time.time()) - self.ttl
+        rows = await store.fetchall("SELECT * FROM pending WHERE created_at>?", (cutoff,))
+        for r in rows:
+            self._items[r["from_id"]] = (r["to_id"], r["created_at"])
+            heapq.heappush(self._heap, (r["created_at"] + self.ttl, r["from_id"]))
+        await store.execute("DELETE FROM pending WHERE created_at<=?", (cutoff,))
 
+    def __len__(self) -> int:
+        return len(self._items)
 
-def get_user(user_id: int):
-    with db() as con:
-        return con.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            self.purge()
 
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
 
-def get_user_by_code(code: str):
-    with db() as con:
-        return con.execute("SELECT * FROM users WHERE code=?", (code,)).fetchone()
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
 
 
-def ensure_stats(user_id: int):
-    t = today_key()
-    with db() as con:
-        row = con.execute("SELECT * FROM stats WHERE user_id=?", (user_id,)).fetchone()
-        if not row:
-            con.execute(
-                "INSERT INTO stats (user_id, link_clicks_total, link_clicks_today, msgs_total, msgs_today, last_day) "
-                "VALUES (?,?,?,?,?,?)",
-                (user_id, 0, 0, 0, 0, t),
-            )
-            con.commit()
-            return
-        if row["last_day"] != t:
-            con.execute(
-                "UPDATE stats SET link_clicks_today=0, msgs_today=0, last_day=? WHERE user_id=?",
-                (t, user_id),
+pending = PendingStore(TTL_SECONDS, persist=PENDING_PERSIST, purge_interval=PENDING_PURGE_SECONDS)
+
+
+def set_pending(from_id: int, to_id: int):
+    pending.set(from_id, to_id)
+
+
+def get_pending(from_id: int) -> dict | None:
+    return pending.get(from_id)
+
+
+def clear_pending(from_id: int):
+    pending.clear(from_id)
+
+
+async def log_message(from_id: int, to_id: int, text: str):
+    write_behind.add(
+        "INSERT INTO logs (from_id, to_id, text, created_at) VALUES (?,?,?,?)",
+        (from_id, to_id, text, int(time.time())),
+    )
+
+
+def _logs_page(con: sqlite3.Connection, before: int | None, after: int | None,
+               from_id: int | None, to_id: int | None, limit: int) -> list:
+    where, params = [], []
+    if from_id is not None:
+        where.append("l.from_id=?")
+        params.append(from_id)
+    if to_id is not None:
+        where.append("l.to_id=?")
+        params.append(to_id)
+    if after is not None:
+        where.append("l.id>?")
+        params.append(after)
+        order = "ASC"
+    else:
+        if before is not None:
+            where.append("l.id<?")
+            params.append(before)
+        order = "DESC"
+    sql = (
+        "SELECT l.id, l.from_id, l.to_id, l.text, l.created_at, "
+        "fu.username AS from_username, fu.full_name AS from_full_name, "
+        "tu.username AS to_username, tu.full_name AS to_full_name "
+        "FROM logs l "
+        "LEFT JOIN users fu ON fu.user_id=l.from_id "
+        "LEFT JOIN users tu ON tu.user_id=l.to_id "
+        + ("WHERE " + " AND ".join(where) + " " if where else "")
+        + f"ORDER BY l.id {order} LIMIT ?"
+    )
+    rows = con.execute(sql, (*params, limit)).fetchall()
+    return rows if order == "DESC" else rows[::-1]
+
+
+_SEARCH_TERM_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def fts_query(text: str) -> str:
+    """
+    Запрос админа -> выражение FTS5. Каждое слово и «фраза в кавычках» берутся в кавычки,
+    чтобы операторы и спецсимволы FTS5 не ломали запрос; слово* — поиск по префиксу.
+    """
+    terms = []
+    for phrase, word in _SEARCH_TERM_RE.findall(text):
+        prefix = False
+        if word:
+            prefix = word.endswith("*")
+            phrase = word.rstrip("*")
+        if phrase.strip():
+            terms.append('"' + phrase.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def _search_logs(con: sqlite3.Connection, match: str, offset: int, limit: int) -> list:
+    # \x02/\x03 — маркеры совпадений, после html.escape заменяются на теги
+    return con.execute(
+        "SELECT l.id, l.from_id, l.to_id, l.created_at, "
+        "snippet(logs_fts, 0, char(2), char(3), '…', 16) AS snippet, "
+        "fu.username AS from_username, fu.full_name AS from_full_name, "
+        "tu.username AS to_username, tu.full_name AS to_full_name "
+        "FROM logs_fts "
+        "JOIN logs l ON l.id=logs_fts.rowid "
+        "LEFT JOIN users fu ON fu.user_id=l.from_id "
+        "LEFT JOIN users tu ON tu.user_id=l.to_id "
+        "WHERE logs_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?",
+        (match, limit, offset),
+    ).fetchall()
+
+
+async def search_logs(match: str, offset: int = 0, limit: int = 25) -> list:
+    """Логи по релевантности (bm25), отправитель и получатель — тем же запросом."""
+    await write_behind.flush()
+    return await store.read(_search_logs, match, offset, limit)
+
+
+async def logs_page(before: int | None = None, after: int | None = None,
+                    from_id: int | None = None, to_id: int | None = None, limit: int = 25) -> list:
+    """
+    Страница логов (новые сверху) по курсору logs.id, отправитель и получатель — тем же запросом.
+    before — страница старше этого id, after — новее.
+    """
+    await write_behind.flush()
+    return await store.read(_logs_page, before, after, from_id, to_id, limit)
+
+
+def _archive_rows(archive_dir: str, rows: list) -> int:
+    """Дописывает строки в logs-YYYY-MM.jsonl.gz (каждая пачка — отдельный gzip member)."""
+    os.makedirs(archive_dir, exist_ok=True)
+    by_month = groupby(rows, key=lambda r: datetime.utcfromtimestamp(r["created_at"]).strftime("%Y-%m"))
+    for month, group in by_month:
+        path = os.path.join(archive_dir, f"logs-{month}.jsonl.gz")
+        with open(path, "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="ab") as gz:
+                for r in group:
+                    gz.write(json.dumps(dict(r), ensure_ascii=False).encode("utf-8") + b"\n")
+            raw.flush()
+            os.fsync(raw.fileno())
+    return len(rows)
+
+
+def _delete_archived(con: sqlite3.Connection, first_id: int, last_id: int, cutoff: int) -> int:
+    return con.execute(
+        "DELETE FROM logs WHERE id BETWEEN ? AND ? AND created_at<?",
+        (first_id, last_id, cutoff),
+    ).rowcount
+
+
+def _incremental_vacuum(con: sqlite3.Connection, pages: int):
+    # execute() шагает по прагме без колонок результата один раз и освобождает одну страницу;
+    # executescript() доводит её до конца
+    con.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+
+
+class LogRetention:
+    """
+    Строки logs старше retention_days уходят в сжатые архивы по месяцам и удаляются
+    из живой таблицы пачками по batch строк; после этого — incremental_vacuum.
+    Сначала пишем архив (fsync), потом удаляем: при падении между ними строки
+    просто попадут в архив повторно (у них есть id).
+    """
+
+    def __init__(self, retention_days: int, archive_dir: str, batch: int = 5000,
+                 interval: int = 3600, vacuum_pages: int = 2000):
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+        self.batch = batch
+        self.interval = interval
+        self.vacuum_pages = vacuum_pages
+        self.archived = 0
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    async def run_once(self) -> int:
+        if self.retention_days <= 0:
+            return 0
+        async with self._lock:
+            return await self._archive_expired()
+
+    async def _archive_expired(self) -> int:
+        await write_behind.flush()
+        cutoff = int(time.time()) - self.retention_days * 86400
+        total = 0
+        while True:
+            rows = await store.fetchall(
+                "SELECT * FROM logs WHERE created_at<? ORDER BY id LIMIT ?",
+                (cutoff, self.batch),
             )
-            con.commit()
+            if not rows:
+                break
+            await asyncio.to_thread(_archive_rows, self.archive_dir, rows)
+            total += await store.write(_delete_archived, rows[0]["id"], rows[-1]["id"], cutoff)
+            if len(rows) < self.batch:
+                break
+            await asyncio.sleep(0)  # даём писателю обслужить остальных между пачками
+        if total:
+            await store.write(_incremental_vacuum, self.vacuum_pages)
+            self.archived += total
+            log.info("retention: archived %s log rows older than %s days", total, self.retention_days)
+        return total
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                log.exception("log retention failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None and self.retention_days > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+
+retention = LogRetention(
+    LOG_RETENTION_DAYS,
+    ARCHIVE_DIR,
+    batch=RETENTION_BATCH,
+    interval=RETENTION_INTERVAL,
+)
 
 
-def inc_click(user_id: int):
-    ensure_stats(user_id)
-    with db() as con:
-        con.execute(
-            "UPDATE stats SET link_clicks_total=link_clicks_total+1, link_clicks_today=link_clicks_today+1 "
-            "WHERE user_id=?",
-            (user_id,),
+def _online_backup(src_path: str, dest: str, pages: int, sleep: float) -> int:
+    """Снимок базы через backup API пачками по pages страниц. Работает в своём потоке и соединении."""
+    tmp = dest + ".part"
+    with suppress(FileNotFoundError):
+        os.remove(tmp)
+    src = sqlite3.connect(src_path, timeout=30)
+    dst = sqlite3.connect(tmp)
+    try:
+        # Открытая транзакция чтения фиксирует снимок (WAL писателя не блокирует). Без неё
+        # backup начинается заново после каждой записи писателя и на живой базе может не закончиться.
+        src.execute("BEGIN")
+        src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()
+        src.backup(dst, pages=pages, sleep=sleep)
+        src.rollback()
+        if dst.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+            raise RuntimeError(f"backup {dest} failed quick_check")
+    finally:
+        dst.close()
+        src.close()
+    os.replace(tmp, dest)
+    return os.path.getsize(dest)
+
+
+def _wal_checkpoint(con: sqlite3.Connection) -> tuple:
+    # PASSIVE не ждёт читателей и не блокирует писателя
+    return tuple(con.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone())
+
+
+def _optimize(con: sqlite3.Connection):
+    con.execute("PRAGMA optimize").fetchall()
+
+
+def _vacuum_free_pages(con: sqlite3.Connection, pages: int) -> int:
+    before = con.execute("PRAGMA freelist_count").fetchone()[0]
+    if before:
+        _incremental_vacuum(con, pages)
+    return before - con.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+class Maintenance:
+    """
+    Обслуживание базы по расписанию: онлайн-снимки с ротацией, WAL checkpoint,
+    PRAGMA optimize и incremental_vacuum. Задачи выполняются по одной; длительность
+    каждой пишется в лог и в метрики. Интервал 0 выключает задачу.
+    """
+
+    def __init__(self, storage: Storage, backup_dir: str, backup_interval: int = 21600,
+                 backup_keep: int = 7, backup_pages: int = 1000, backup_sleep: float = 0.01,
+                 checkpoint_interval: int = 300, optimize_interval: int = 21600,
+                 vacuum_interval: int = 3600, vacuum_pages: int = 2000):
+        self.storage = storage
+        self.backup_dir = backup_dir
+        self.backup_keep = backup_keep
+        self.backup_pages = backup_pages
+        self.backup_sleep = backup_sleep
+        self.vacuum_pages = vacuum_pages
+        self.jobs = {
+            "backup": (backup_interval, self.backup),
+            "checkpoint": (checkpoint_interval, self.checkpoint),
+            "optimize": (optimize_interval, self.optimize),
+            "vacuum": (vacuum_interval, self.vacuum),
+        }
+        self.last: dict[str, tuple[float, float, str]] = {}  # задача -> (когда, секунд, результат)
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def _backups(self) -> list[str]:
+        prefix = os.path.splitext(os.path.basename(self.storage.path))[0] + "-"
+        with suppress(FileNotFoundError):
+            return sorted(
+                os.path.join(self.backup_dir, name) for name in os.listdir(self.backup_dir)
+                if name.startswith(prefix) and name.endswith(".sqlite3")
+            )
+        return []
+
+    async def backup(self) -> str:
+        os.makedirs(self.backup_dir, exist_ok=True)
+        base = os.path.splitext(os.path.basename(self.storage.path))[0]
+        dest = os.path.join(self.backup_dir, f"{base}-{datetime.utcnow():%Y%m%d-%H%M%S}.sqlite3")
+        size = await asyncio.to_thread(
+            _online_backup, self.storage.path, dest, self.backup_pages, self.backup_sleep
         )
-        con.commit()
+        for old in self._backups()[:-self.backup_keep]:
+            os.remove(old)
+        return f"{os.path.basename(dest)}, {size / (1024 * 1024):.1f} MB"
+
+    async def checkpoint(self) -> str:
+        busy, wal_pages, done = await self.storage.write(_wal_checkpoint)
+        return f"busy={busy} wal={wal_pages} checkpointed={done}"
+
+    async def optimize(self) -> str:
+        await self.storage.write(_optimize)
+        return "ok"
+
+    async def vacuum(self) -> str:
+        return f"freed {await self.storage.write(_vacuum_free_pages, self.vacuum_pages)} pages"
+
+    async def run_job(self, name: str) -> str | None:
+        _, fn = self.jobs[name]
+        async with self._lock:
+            t0 = time.perf_counter()
+            try:
+                result = await fn()
+            except Exception:
+                metrics.inc("bot_maintenance_errors_total", name)
+                log.exception("maintenance: %s failed", name)
+                return None
+            finally:
+                elapsed = time.perf_counter() - t0
+                metrics.observe("bot_maintenance_seconds", elapsed, name)
+            self.last[name] = (time.time(), elapsed, result)
+            log.info("maintenance: %s took %.3fs (%s)", name, elapsed, result)
+            return result
+
+    async def _run(self):
+        now = time.time()
+        due = {name: now + interval for name, (interval, _) in self.jobs.items() if interval > 0}
+        if "backup" in due:
+            # после рестарта отсчитываем от последнего снимка, а не делаем новый на каждый деплой
+            backups = self._backups()
+            if backups:
+                due["backup"] = os.path.getmtime(backups[-1]) + self.jobs["backup"][0]
+        while True:
+            name = min(due, key=due.get)
+            await asyncio.sleep(max(0.0, due[name] - time.time()))
+            await self.run_job(name)
+            due[name] = time.time() + self.jobs[name][0]
+
+    def start(self):
+        if self._task is None and any(interval > 0 for interval, _ in self.jobs.values()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+
+maintenance = Maintenance(
+    store,
+    BACKUP_DIR,
+    backup_interval=BACKUP_INTERVAL,
+    backup_keep=BACKUP_KEEP,
+    backup_pages=BACKUP_PAGES,
+    backup_sleep=BACKUP_SLEEP_MS / 1000,
+    checkpoint_interval=CHECKPOINT_INTERVAL,
+    optimize_interval=OPTIMIZE_INTERVAL,
+    vacuum_interval=VACUUM_INTERVAL,
+)
 
 
-def inc_msg(user_id: int):
-    ensure_stats(user_id)
-    with db() as con:
-        con.execute(
-            "UPDATE stats SET msgs_total=msgs_total+1, msgs_today=msgs_today+1 WHERE user_id=?",
-            (user_id,),
-        )
-        con.commit()
+async def set_lang(user_id: int, lang: str):
+    await store.execute("UPDATE users SET lang=? WHERE user_id=?", (lang, user_id))
+    u = user_cache.get(user_id)
+    if u is not None:
+        user_cache.put(user_id, {**u, "lang": lang})
 
 
-def get_stats(user_id: int):
-    ensure_stats(user_id)
-    with db() as con:
-        return con.execute("SELECT * FROM stats WHERE user_id=?", (user_id,)).fetchone()
+# =========================
+# BOT IDENTITY / LINKS
+# =========================
+class BotIdentity:
+    """
+    username бота берём один раз при старте (и изредка обновляем),
+    ссылки пользователей держим в памяти: user_id -> https://t.me/...?start=code
+    """
+
+    def __init__(self, bot: Bot, refresh_seconds: int = 3600, max_links: int = 50_000):
+        self.bot = bot
+        self.refresh_seconds = refresh_seconds
+        self.username: str | None = None
+        self.links = LRUCache(max_links)
+        self._task: asyncio.Task | None = None
+
+    async def refresh(self):
+        me = await self.bot.get_me()
+        if me.username != self.username:
+            self.username = me.username
+            self.links.clear()
+
+    async def ensure(self) -> str:
+        if self.username is None:
+            await self.refresh()
+        return self.username
+
+    def link(self, code: str) -> str:
+        return f"https://t.me/{self.username}?start={code}"
+
+    def group_link(self) -> str:
+        return f"https://t.me/{self.username}?startgroup=1"
+
+    def cached_link(self, user_id: int) -> str | None:
+        return self.links.get(user_id)
+
+    def remember(self, user_id: int, code: str) -> str:
+        link = self.link(code)
+        self.links.put(user_id, link)
+        return link
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await self.refresh()
+            except Exception:
+                log.exception("get_me refresh failed")
 
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
 
-def set_pending(from_id: int, to_id: int):
-    with db() as con:
-        con.execute(
-            "INSERT OR REPLACE INTO pending (from_id, to_id, created_at) VALUES (?,?,?)",
-            (from_id, to_id, int(time.time())),
-        )
-        con.commit()
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
 
 
-def get_pending(from_id: int):
-    with db() as con:
-        return con.execute("SELECT * FROM pending WHERE from_id=?", (from_id,)).fetchone()
+identity = BotIdentity(bot, refresh_seconds=BOT_ME_REFRESH, max_links=LINK_CACHE_SIZE)
 
 
-def clear_pending(from_id: int):
-    with db() as con:
-        con.execute("DELETE FROM pending WHERE from_id=?", (from_id,))
-        con.commit()
+# =========================
+# OUTBOUND (лимиты Telegram)
+# =========================
+PRIO_USER = 0  # ответ самому пользователю
+PRIO_RELAY = 1  # анонимное сообщение получателю
+PRIO_ADMIN = 2  # копии админу
+PRIO_BULK = 3  # массовые рассылки
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self) -> bool:
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return False
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def wait_time(self) -> float:
+        """Через сколько секунд появится токен (0 — уже есть)."""
+        now = time.monotonic()
+        self._refill(now)
+        return max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0.0)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Outbox:
+    """
+    Все исходящие запросы к Bot API идут через общую очередь с приоритетами:
+    глобальный лимит (~30 msg/s), лимит на чат, повтор после RetryAfter
+    и экспоненциальный backoff на сетевых/5xx ошибках.
+    Запрос в чат без свободного токена не держит воркер: он ждёт в очереди
+    своего чата и возвращается в общую, когда токен появится.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        rate: float = 30,
+        chat_rate: float = 1,
+        chat_burst: float = 3,
+        workers: int = 8,
+        max_retries: int = 5,
+    ):
+        self.bot = bot
+        self.workers = workers
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(rate, rate)
+        self._chats = LRUCache(100_000)  # chat_id -> TokenBucket
+        self._waiting: dict = {}  # chat_id -> heap запросов, ждущих токен чата
+        self._deferred = 0  # запросов вне общей очереди: ждут токен чата или повтора
+        self._queue: asyncio.PriorityQueue | None = None
+        self._seq = count()
+        self._tasks: list[asyncio.Task] = []
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.inflight = 0
+        self.max_depth = 0
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            b = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats.put(chat_id, b)
+        return b
+
+    def _put(self, priority: int, seq: int, method, fut: asyncio.Future, attempt: int, ready: bool = False):
+        # ready — токен чата уже взят в _release
+        self._queue.put_nowait((priority, seq, method, fut, attempt, ready))
+        self.max_depth = max(self.max_depth, self.depth())
+
+    def _later(self, delay: float, priority: int, seq: int, method, fut: asyncio.Future, attempt: int):
+        self._deferred += 1
+
+        def put():
+            self._deferred -= 1
+            self._put(priority, seq, method, fut, attempt)
+
+        asyncio.get_running_loop().call_later(delay, put)
+
+    def _defer(self, chat_id, item: tuple):
+        waiting = self._waiting.get(chat_id)
+        if waiting is None:
+            waiting = self._waiting[chat_id] = []
+            asyncio.get_running_loop().call_later(self._bucket(chat_id).wait_time(), self._release, chat_id)
+        heapq.heappush(waiting, item)
+        self._deferred += 1
+
+    def _release(self, chat_id):
+        """Отдаёт следующий запрос чата в общую очередь, как только у чата есть токен."""
+        waiting = self._waiting[chat_id]
+        bucket = self._bucket(chat_id)
+        if bucket.try_take():
+            priority, seq, method, fut, attempt, _ = heapq.heappop(waiting)
+            self._deferred -= 1
+            self._put(priority, seq, method, fut, attempt, ready=True)
+        if waiting:
+            asyncio.get_running_loop().call_later(max(bucket.wait_time(), 0.001), self._release, chat_id)
+        else:
+            del self._waiting[chat_id]
+
+    def submit(self, method, priority: int = PRIO_USER) -> asyncio.Future:
+        if self._queue is None:
+            self.start()
+        fut = asyncio.get_running_loop().create_future()
+        self._put(priority, next(self._seq), method, fut, 0)
+        return fut
+
+    async def send(self, method, priority: int = PRIO_USER):
+        """Поставить запрос в очередь и дождаться ответа API."""
+        return await self.submit(method, priority)
+
+    def post(self, method, priority: int = PRIO_USER):
+        """Поставить запрос в очередь без ожидания (ошибки только в лог)."""
+        self.submit(method, priority).add_done_callback(_log_send_error)
+
+    async def _worker(self):
+        while True:
+            priority, seq, method, fut, attempt, ready = await self._queue.get()
+            chat_id = getattr(method, "chat_id", None)
+            try:
+                if fut.done():
+                    continue
+                if chat_id is not None and not ready:
+                    # пока у чата есть очередь, новые запросы встают в её конец — порядок внутри чата сохраняется
+                    if chat_id in self._waiting or not self._bucket(chat_id).try_take():
+                        self._defer(chat_id, (priority, seq, method, fut, attempt, False))
+                        continue
+                await self.global_bucket.acquire()
+                self.inflight += 1
+                try:
+                    result = await self.bot(method)
+                finally:
+                    self.inflight -= 1
+            except TelegramRetryAfter as e:
+                self.retried += 1
+                if chat_id is not None:
+                    self._bucket(chat_id).block(e.retry_after)
+                    self._defer(chat_id, (priority, seq, method, fut, attempt, False))
+                else:
+                    self.global_bucket.block(e.retry_after)
+                    self._later(e.retry_after, priority, seq, method, fut, attempt)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt >= self.max_retries:
+                    self.failed += 1
+                    _resolve(fut, exc=e)
+                else:
+                    self.retried += 1
+                    self._later(min(30.0, 0.5 * 2 ** attempt), priority, seq, method, fut, attempt + 1)
+            except asyncio.CancelledError:
+                if not fut.done():
+                    fut.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                _resolve(fut, exc=e)
+            else:
+                self.sent += 1
+                _resolve(fut, result=result)
+            finally:
+                self._queue.task_done()
+
+    def depth(self) -> int:
+        return (self._queue.qsize() if self._queue is not None else 0) + self._deferred
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth(),
+            "max_depth": self.max_depth,
+            "inflight": self.inflight,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+    def start(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        # отложенные запросы не в очереди, поэтому ждём по depth(), а не queue.join()
+        deadline = time.monotonic() + timeout
+        while (self.depth() or self.inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for t in self._tasks:
+            t.cancel()
+        for t in self._tasks:
+            with suppress(asyncio.CancelledError):
+                await t
+        self._tasks = []
+
+
+def _resolve(fut: asyncio.Future, result=None, exc: BaseException | None = None):
+    if fut.done():  # вызывающий мог уже отменить ожидание
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(result)
 
 
-def log_message(from_id: int, to_id: int, text: str):
-    with db() as con:
-        con.execute(
-            "INSERT INTO logs (from_id, to_id, text, created_at) VALUES (?,?,?,?)",
-            (from_id, to_id, text, int(time.time())),
-        )
-        con.commit()
+def _log_send_error(fut: asyncio.Future):
+    if not fut.cancelled() and fut.exception() is not None:
+        log.warning("send failed: %r", fut.exception())
 
 
-def last_logs(limit: int = 20):
-    with db() as con:
-        return con.execute("SELECT * FROM logs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+outbox = Outbox(
+    bot,
+    rate=SEND_RATE,
+    chat_rate=SEND_CHAT_RATE,
+    chat_burst=SEND_CHAT_BURST,
+    workers=SEND_WORKERS,
+)
 
 
-def set_lang(user_id: int, lang: str):
-    with db() as con:
-        con.execute("UPDATE users SET lang=? WHERE user_id=?", (lang, user_id))
-        con.commit()
+# =========================
+# I18N
+# =========================
+# Тексты интерфейса на всех языках из kb_lang. Плейсхолдеры — в синтаксисе str.format,
+# у всех языков набор ключей и плейсхолдеров должен совпадать с ru (проверяется при старте).
+CATALOG = {
+    "ru": {
+        "home": (
+            "Начните получать анонимные вопросы прямо сейчас!\n\n"
+            "Ваша ссылка:\n"
+            "{link_block}\n\n"
+            "Разместите эту ссылку ☝️ в описании своего профиля Telegram, TikTok, Instagram (stories), "
+            "чтобы вам могли написать 💬"
+        ),
+        "url": "Ваша ссылка:\n{link_block}",
+        "stats": (
+            "📊 <b>Статистика</b>\n\n"
+            "Сегодня:\n"
+            "💬 Сообщений: <b>{msgs_today}</b>\n"
+            "👀 Переходов по ссылке: <b>{clicks_today}</b>\n\n"
+            "За 7 дней: 💬 <b>{msgs_7d}</b> · 👀 <b>{clicks_7d}</b>\n"
+            "За 30 дней: 💬 <b>{msgs_30d}</b> · 👀 <b>{clicks_30d}</b>\n\n"
+            "По дням (💬 / 👀):\n"
+            "{series}\n\n"
+            "За всё время:\n"
+            "💬 Сообщений: <b>{msgs_total}</b>\n"
+            "👀 Переходов по ссылке: <b>{clicks_total}</b>\n\n"
+            "Ваша ссылка:\n"
+            "{link_block}"
+        ),
+        "help_ui": (
+            "ℹ️ <b>Помощь</b>\n\n"
+            "Как получать сообщения:\n"
+            "1) Нажмите /start и возьмите свою ссылку.\n"
+            "2) Разместите ссылку в профиле/сторис.\n\n"
+            "Как написать человеку:\n"
+            "— откройте его ссылку и отправьте сообщение/фото/стикер/файл.\n\n"
+            "Команды:\n"
+            "/start — старт\n"
+            "/url — ваша ссылка\n"
+            "/stats — статистика\n"
+            "/help — помощь"
+        ),
+        "help_cmd": (
+            "ℹ️ <b>Помощь</b>\n\n"
+            "Как получать сообщения:\n"
+            "1) /start → возьмите ссылку.\n"
+            "2) Разместите ссылку.\n\n"
+            "Что можно отправлять:\n"
+            "Текст, фото, стикеры, файлы.\n\n"
+            "Команды:\n"
+            "/start — старт\n"
+            "/url — ваша ссылка\n"
+            "/stats — статистика\n"
+            "/help — помощь"
+        ),
+        "lang_choose": "🌍 <b>Выберите язык:</b>",
+        "lang_done": "✅ Готово",
+        "write_prompt": "✍️ Напишите ваше сообщение — оно будет отправлено анонимно.",
+        "reply_prompt": "✍️ Напишите ответ — он будет отправлен анонимно.",
+        "write_more_prompt": "✍️ Напишите сообщение — оно будет отправлено анонимно.",
+        "write_more_none": "Откройте ссылку человека (t.me/бот?start=код), чтобы написать ему.",
+        "open_link_first": "Открой эту ссылку (нажми на неё), затем напиши сообщение в боте.",
+        "no_pending": "Чтобы написать человеку — открой его ссылку (t.me/бот?start=код).",
+        "expired": "⏳ Время истекло. Открой ссылку человека заново.",
+        "empty": "Пустое сообщение не отправляю.",
+        "unsupported": "Я могу отправлять текст, фото, стикеры и файлы.",
+        "sent": "✅ Отправлено!",
+        "album_failed": "Не удалось отправить альбом.",
+        "anon_text": "📩 Вам пришло анонимное сообщение:\n\n{text}",
+        "anon_photo": "📩 Вам пришло анонимное фото.",
+        "anon_document": "📩 Вам пришёл анонимный файл.",
+        "anon_video": "📩 Вам пришло анонимное видео.",
+        "anon_animation": "📩 Вам пришла анонимная гифка.",
+        "anon_audio": "📩 Вам пришло анонимное аудио.",
+        "anon_voice": "📩 Вам пришло анонимное голосовое.",
+        "anon_album": "📩 Вам пришёл анонимный альбом ({count}).",
+        "share_text": "Напиши мне анонимно 💬",
+        "btn_share": "🔗 Поделиться ссылкой",
+        "btn_add_group": "➕ Добавить бота в группу",
+        "btn_stats": "📊 Статистика",
+        "btn_lang": "🌍 Язык",
+        "btn_help": "ℹ️ Помощь",
+        "btn_back": "⬅️ Назад",
+        "btn_write_more": "✍️ Написать ещё",
+        "btn_reply": "💬 Ответить",
+    },
+    "en": {
+        "home": (
+            "Start receiving anonymous questions right now!\n\n"
+            "Your link:\n"
+            "{link_block}\n\n"
+            "Put this link ☝️ in your Telegram, TikTok or Instagram (stories) profile "
+            "so people can message you 💬"
+        ),
+        "url": "Your link:\n{link_block}",
+        "stats": (
+            "📊 <b>Statistics</b>\n\n"
+            "Today:\n"
+            "💬 Messages: <b>{msgs_today}</b>\n"
+            "👀 Link clicks: <b>{clicks_today}</b>\n\n"
+            "Last 7 days: 💬 <b>{msgs_7d}</b> · 👀 <b>{clicks_7d}</b>\n"
+            "Last 30 days: 💬 <b>{msgs_30d}</b> · 👀 <b>{clicks_30d}</b>\n\n"
+            "By day (💬 / 👀):\n"
+            "{series}\n\n"
+            "All time:\n"
+            "💬 Messages: <b>{msgs_total}</b>\n"
+            "👀 Link clicks: <b>{clicks_total}</b>\n\n"
+            "Your link:\n"
+            "{link_block}"
+        ),
+        "help_ui": (
+            "ℹ️ <b>Help</b>\n\n"
+            "How to receive messages:\n"
+            "1) Press /start and take your link.\n"
+            "2) Put the link in your profile/stories.\n\n"
+            "How to write to someone:\n"
+            "— open their link and send a message/photo/sticker/file.\n\n"
+            "Commands:\n"
+            "/start — start\n"
+            "/url — your link\n"
+            "/stats — statistics\n"
+            "/help — help"
+        ),
+        "help_cmd": (
+            "ℹ️ <b>Help</b>\n\n"
+            "How to receive messages:\n"
+            "1) /start → take your link.\n"
+            "2) Share the link.\n\n"
+            "What you can send:\n"
+            "Text, photos, stickers, files.\n\n"
+            "Commands:\n"
+            "/start — start\n"
+            "/url — your link\n"
+            "/stats — statistics\n"
+            "/help — help"
+        ),
+        "lang_choose": "🌍 <b>Choose your language:</b>",
+        "lang_done": "✅ Done",
+        "write_prompt": "✍️ Write your message — it will be sent anonymously.",
+        "reply_prompt": "✍️ Write your reply — it will be sent anonymously.",
+        "write_more_prompt": "✍️ Write a message — it will be sent anonymously.",
+        "write_more_none": "Open the person's link (t.me/bot?start=code) to write to them.",
+        "open_link_first": "Open this link (tap it), then write your message in the bot.",
+        "no_pending": "To write to someone, open their link (t.me/bot?start=code).",
+        "expired": "⏳ Time is up. Open the person's link again.",
+        "empty": "I don't send empty messages.",
+        "unsupported": "I can send text, photos, stickers and files.",
+        "sent": "✅ Sent!",
+        "album_failed": "Could not send the album.",
+        "anon_text": "📩 You have a new anonymous message:\n\n{text}",
+        "anon_photo": "📩 You have a new anonymous photo.",
+        "anon_document": "📩 You have a new anonymous file.",
+        "anon_video": "📩 You have a new anonymous video.",
+        "anon_animation": "📩 You have a new anonymous GIF.",
+        "anon_audio": "📩 You have a new anonymous audio.",
+        "anon_voice": "📩 You have a new anonymous voice message.",
+        "anon_album": "📩 You have a new anonymous album ({count}).",
+        "share_text": "Message me anonymously 💬",
+        "btn_share": "🔗 Share link",
+        "btn_add_group": "➕ Add bot to a group",
+        "btn_stats": "📊 Statistics",
+        "btn_lang": "🌍 Language",
+        "btn_help": "ℹ️ Help",
+        "btn_back": "⬅️ Back",
+        "btn_write_more": "✍️ Write more",
+        "btn_reply": "💬 Reply",
+    },
+    "uk": {
+        "home": (
+            "Почніть отримувати анонімні питання просто зараз!\n\n"
+            "Ваше посилання:\n"
+            "{link_block}\n\n"
+            "Розмістіть це посилання ☝️ в описі свого профілю Telegram, TikTok, Instagram (stories), "
+            "щоб вам могли написати 💬"
+        ),
+        "url": "Ваше посилання:\n{link_block}",
+        "stats": (
+            "📊 <b>Статистика</b>\n\n"
+            "Сьогодні:\n"
+            "💬 Повідомлень: <b>{msgs_today}</b>\n"
+            "👀 Переходів за посиланням: <b>{clicks_today}</b>\n\n"
+            "За 7 днів: 💬 <b>{msgs_7d}</b> · 👀 <b>{clicks_7d}</b>\n"
+            "За 30 днів: 💬 <b>{msgs_30d}</b> · 👀 <b>{clicks_30d}</b>\n\n"
+            "По днях (💬 / 👀):\n"
+            "{series}\n\n"
+            "За весь час:\n"
+            "💬 Повідомлень: <b>{msgs_total}</b>\n"
+            "👀 Переходів за посиланням: <b>{clicks_total}</b>\n\n"
+            "Ваше посилання:\n"
+            "{link_block}"
+        ),
+        "help_ui": (
+            "ℹ️ <b>Допомога</b>\n\n"
+            "Як отримувати повідомлення:\n"
+            "1) Натисніть /start і візьміть своє посилання.\n"
+            "2) Розмістіть посилання у профілі/сторіс.\n\n"
+            "Як написати людині:\n"
+            "— відкрийте її посилання і надішліть повідомлення/фото/стікер/файл.\n\n"
+            "Команди:\n"
+            "/start — старт\n"
+            "/url — ваше посилання\n"
+            "/stats — статистика\n"
+            "/help — допомога"
+        ),
+        "help_cmd": (
+            "ℹ️ <b>Допомога</b>\n\n"
+            "Як отримувати повідомлення:\n"
+            "1) /start → візьміть посилання.\n"
+            "2) Розмістіть посилання.\n\n"
+            "Що можна надсилати:\n"
+            "Текст, фото, стікери, файли.\n\n"
+            "Команди:\n"
+            "/start — старт\n"
+            "/url — ваше посилання\n"
+            "/stats — статистика\n"
+            "/help — допомога"
+        ),
+        "lang_choose": "🌍 <b>Оберіть мову:</b>",
+        "lang_done": "✅ Готово",
+        "write_prompt": "✍️ Напишіть ваше повідомлення — його буде надіслано анонімно.",
+        "reply_prompt": "✍️ Напишіть відповідь — її буде надіслано анонімно.",
+        "write_more_prompt": "✍️ Напишіть повідомлення — його буде надіслано анонімно.",
+        "write_more_none": "Відкрийте посилання людини (t.me/бот?start=код), щоб написати їй.",
+        "open_link_first": "Відкрий це посилання (натисни на нього), потім напиши повідомлення в боті.",
+        "no_pending": "Щоб написати людині — відкрий її посилання (t.me/бот?start=код).",
+        "expired": "⏳ Час вийшов. Відкрий посилання людини знову.",
+        "empty": "Порожнє повідомлення не надсилаю.",
+        "unsupported": "Я можу надсилати текст, фото, стікери та файли.",
+        "sent": "✅ Надіслано!",
+        "album_failed": "Не вдалося надіслати альбом.",
+        "anon_text": "📩 Вам надійшло анонімне повідомлення:\n\n{text}",
+        "anon_photo": "📩 Вам надійшло анонімне фото.",
+        "anon_document": "📩 Вам надійшов анонімний файл.",
+        "anon_video": "📩 Вам надійшло анонімне відео.",
+        "anon_animation": "📩 Вам надійшла анонімна гіфка.",
+        "anon_audio": "📩 Вам надійшло анонімне аудіо.",
+        "anon_voice": "📩 Вам надійшло анонімне голосове.",
+        "anon_album": "📩 Вам надійшов анонімний альбом ({count}).",
+        "share_text": "Напиши мені анонімно 💬",
+        "btn_share": "🔗 Поділитися посиланням",
+        "btn_add_group": "➕ Додати бота в групу",
+        "btn_stats": "📊 Статистика",
+        "btn_lang": "🌍 Мова",
+        "btn_help": "ℹ️ Допомога",
+        "btn_back": "⬅️ Назад",
+        "btn_write_more": "✍️ Написати ще",
+        "btn_reply": "💬 Відповісти",
+    },
+    "de": {
+        "home": (
+            "Erhalte ab sofort anonyme Fragen!\n\n"
+            "Dein Link:\n"
+            "{link_block}\n\n"
+            "Füge diesen Link ☝️ in dein Telegram-, TikTok- oder Instagram-Profil (Stories) ein, "
+            "damit man dir schreiben kann 💬"
+        ),
+        "url": "Dein Link:\n{link_block}",
+        "stats": (
+            "📊 <b>Statistik</b>\n\n"
+            "Heute:\n"
+            "💬 Nachrichten: <b>{msgs_today}</b>\n"
+            "👀 Link-Aufrufe: <b>{clicks_today}</b>\n\n"
+            "Letzte 7 Tage: 💬 <b>{msgs_7d}</b> · 👀 <b>{clicks_7d}</b>\n"
+            "Letzte 30 Tage: 💬 <b>{msgs_30d}</b> · 👀 <b>{clicks_30d}</b>\n\n"
+            "Pro Tag (💬 / 👀):\n"
+            "{series}\n\n"
+            "Insgesamt:\n"
+            "💬 Nachrichten: <b>{msgs_total}</b>\n"
+            "👀 Link-Aufrufe: <b>{clicks_total}</b>\n\n"
+            "Dein Link:\n"
+            "{link_block}"
+        ),
+        "help_ui": (
+            "ℹ️ <b>Hilfe</b>\n\n"
+            "So bekommst du Nachrichten:\n"
+            "1) Tippe auf /start und hol dir deinen Link.\n"
+            "2) Teile den Link in deinem Profil/deinen Stories.\n\n"
+            "So schreibst du jemandem:\n"
+            "— öffne seinen Link und sende eine Nachricht/ein Foto/einen Sticker/eine Datei.\n\n"
+            "Befehle:\n"
+            "/start — Start\n"
+            "/url — dein Link\n"
+            "/stats — Statistik\n"
+            "/help — Hilfe"
+        ),
+        "help_cmd": (
+            "ℹ️ <b>Hilfe</b>\n\n"
+            "So bekommst du Nachrichten:\n"
+            "1) /start → hol dir deinen Link.\n"
+            "2) Teile den Link.\n\n"
+            "Was du senden kannst:\n"
+            "Text, Fotos, Sticker, Dateien.\n\n"
+            "Befehle:\n"
+            "/start — Start\n"
+            "/url — dein Link\n"
+            "/stats — Statistik\n"
+            "/help — Hilfe"
+        ),
+        "lang_choose": "🌍 <b>Sprache wählen:</b>",
+        "lang_done": "✅ Fertig",
+        "write_prompt": "✍️ Schreib deine Nachricht — sie wird anonym gesendet.",
+        "reply_prompt": "✍️ Schreib deine Antwort — sie wird anonym gesendet.",
+        "write_more_prompt": "✍️ Schreib eine Nachricht — sie wird anonym gesendet.",
+        "write_more_none": "Öffne den Link der Person (t.me/bot?start=code), um ihr zu schreiben.",
+        "open_link_first": "Öffne diesen Link (tippe darauf) und schreib dann deine Nachricht im Bot.",
+        "no_pending": "Um jemandem zu schreiben, öffne seinen Link (t.me/bot?start=code).",
+        "expired": "⏳ Die Zeit ist abgelaufen. Öffne den Link der Person erneut.",
+        "empty": "Leere Nachrichten sende ich nicht.",
+        "unsupported": "Ich kann Text, Fotos, Sticker und Dateien senden.",
+        "sent": "✅ Gesendet!",
+        "album_failed": "Das Album konnte nicht gesendet werden.",
+        "anon_text": "📩 Du hast eine anonyme Nachricht erhalten:\n\n{text}",
+        "anon_photo": "📩 Du hast ein anonymes Foto erhalten.",
+        "anon_document": "📩 Du hast eine anonyme Datei erhalten.",
+        "anon_video": "📩 Du hast ein anonymes Video erhalten.",
+        "anon_animation": "📩 Du hast ein anonymes GIF erhalten.",
+        "anon_audio": "📩 Du hast eine anonyme Audiodatei erhalten.",
+        "anon_voice": "📩 Du hast eine anonyme Sprachnachricht erhalten.",
+        "anon_album": "📩 Du hast ein anonymes Album erhalten ({count}).",
+        "share_text": "Schreib mir anonym 💬",
+        "btn_share": "🔗 Link teilen",
+        "btn_add_group": "➕ Bot zu einer Gruppe hinzufügen",
+        "btn_stats": "📊 Statistik",
+        "btn_lang": "🌍 Sprache",
+        "btn_help": "ℹ️ Hilfe",
+        "btn_back": "⬅️ Zurück",
+        "btn_write_more": "✍️ Noch schreiben",
+        "btn_reply": "💬 Antworten",
+    },
+}
+DEFAULT_LANG = "ru"
+
+
+def _placeholders(template: str) -> set[str]:
+    return {name for _, name, _, _ in Formatter().parse(template) if name}
+
+
+def compile_catalog(catalog: dict) -> dict:
+    """Проверяет каталог и превращает строки в готовые к вызову str.format."""
+    base = catalog[DEFAULT_LANG]
+    compiled = {}
+    for lang, texts in catalog.items():
+        if texts.keys() != base.keys():
+            raise RuntimeError(f"i18n: {lang} keys differ from {DEFAULT_LANG}: {texts.keys() ^ base.keys()}")
+        for key, template in texts.items():
+            if _placeholders(template) != _placeholders(base[key]):
+                raise RuntimeError(f"i18n: placeholders differ in {lang}.{key}")
+        compiled[lang] = {key: template.format for key, template in texts.items()}
+    return compiled
+
+
+TEXTS = compile_catalog(CATALOG)
+LANGS = tuple(TEXTS)
+
+
+def t(lang: str, key: str, **kwargs) -> str:
+    return TEXTS.get(lang, TEXTS[DEFAULT_LANG])[key](**kwargs)
+
+
+async def user_lang(user_id: int) -> str:
+    u = await get_user(user_id)
+    return u["lang"] if u is not None and u["lang"] in TEXTS else DEFAULT_LANG
 
 
 # =========================
@@ -235,39 +2174,38 @@ def format_user(u) -> str:
 
 
 async def get_my_link(user_id: int) -> str:
-    u = get_user(user_id)
-    me = await bot.get_me()
-    return f"https://t.me/{me.username}?start={u['code']}"
+    link = identity.cached_link(user_id)
+    if link is not None:
+        return link
+    u = await get_user(user_id)
+    await identity.ensure()
+    return identity.remember(user_id, u["code"])
 
 
-def share_url(link: str) -> str:
-    text = "Напиши мне анонимно 💬"
+def share_url(link: str, lang: str = DEFAULT_LANG) -> str:
+    text = t(lang, "share_text")
     return f"https://t.me/share/url?url={link}&text={text}"
 
 
-async def kb_home(user_id: int) -> InlineKeyboardMarkup:
-    me = await bot.get_me()
-    link = await get_my_link(user_id)
-    group_link = f"https://t.me/{me.username}?startgroup=1"
-
+def _build_kb_home(link: str, lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔗 Поделиться ссылкой", url=share_url(link))],
-        [InlineKeyboardButton(text="➕ Добавить бота в группу", url=group_link)],
+        [InlineKeyboardButton(text=t(lang, "btn_share"), url=share_url(link, lang))],
+        [InlineKeyboardButton(text=t(lang, "btn_add_group"), url=identity.group_link())],
         [
-            InlineKeyboardButton(text="📊 Статистика", callback_data="ui:stats"),
-            InlineKeyboardButton(text="🌍 Язык", callback_data="ui:lang"),
+            InlineKeyboardButton(text=t(lang, "btn_stats"), callback_data="ui:stats"),
+            InlineKeyboardButton(text=t(lang, "btn_lang"), callback_data="ui:lang"),
         ],
-        [InlineKeyboardButton(text="ℹ️ Помощь", callback_data="ui:help")],
+        [InlineKeyboardButton(text=t(lang, "btn_help"), callback_data="ui:help")],
     ])
 
 
-def kb_back_home() -> InlineKeyboardMarkup:
+def _build_kb_back_home(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="ui:home")]
+        [InlineKeyboardButton(text=t(lang, "btn_back"), callback_data="ui:home")]
     ])
 
 
-def kb_lang() -> InlineKeyboardMarkup:
+def _build_kb_lang(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [
             InlineKeyboardButton(text="🇷🇺 Русский", callback_data="lang:ru"),
@@ -277,26 +2215,378 @@ def kb_lang() -> InlineKeyboardMarkup:
             InlineKeyboardButton(text="🇺🇦 Українська", callback_data="lang:uk"),
             InlineKeyboardButton(text="🇩🇪 Deutsch", callback_data="lang:de"),
         ],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="ui:home")],
+        [InlineKeyboardButton(text=t(lang, "btn_back"), callback_data="ui:home")],
     ])
 
 
-def kb_write_more() -> InlineKeyboardMarkup:
+def _build_kb_write_more(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✍️ Написать ещё", callback_data="ui:write_more")]
+        [InlineKeyboardButton(text=t(lang, "btn_write_more"), callback_data="ui:write_more")]
     ])
 
 
-async def send_admin_log(from_id: int, to_id: int, text: str):
-    fu = get_user(from_id)
-    tu = get_user(to_id)
-    msg = (
-        "🛡 <b>ADMIN LOG</b>\n"
-        f"От: {format_user(fu)}\n"
-        f"Кому: {format_user(tu)}\n"
-        f"Сообщение: {text}"
+def _build_kb_reply(sender_id: int, lang: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text=t(lang, "btn_reply"),
+            callback_data=f"reply:{sender_id}"
+        )]
+    ])
+
+
+# Статические клавиатуры собираются один раз на язык, и один экземпляр уходит во все запросы.
+# Модели aiogram не frozen (frozen=False, validate_assignment=True) — делить их безопасно,
+# только пока никто не меняет: готовую клавиатуру не трогаем, а для правок собираем новую.
+KB_BACK_HOME = MappingProxyType({lang: _build_kb_back_home(lang) for lang in LANGS})
+KB_LANG = MappingProxyType({lang: _build_kb_lang(lang) for lang in LANGS})
+KB_WRITE_MORE = MappingProxyType({lang: _build_kb_write_more(lang) for lang in LANGS})
+
+# Персональные — в LRU: (user_id, lang) -> (link, text, kb) для главного экрана,
+# (sender_id, lang) -> kb для кнопки «Ответить».
+home_cache = LRUCache(KB_CACHE_SIZE)
+reply_kb_cache = LRUCache(KB_CACHE_SIZE)
+
+
+def kb_back_home(lang: str = DEFAULT_LANG) -> InlineKeyboardMarkup:
+    return KB_BACK_HOME.get(lang) or KB_BACK_HOME[DEFAULT_LANG]
+
+
+def kb_lang(lang: str = DEFAULT_LANG) -> InlineKeyboardMarkup:
+    return KB_LANG.get(lang) or KB_LANG[DEFAULT_LANG]
+
+
+def kb_write_more(lang: str = DEFAULT_LANG) -> InlineKeyboardMarkup:
+    return KB_WRITE_MORE.get(lang) or KB_WRITE_MORE[DEFAULT_LANG]
+
+
+def kb_reply(sender_id: int, lang: str = DEFAULT_LANG) -> InlineKeyboardMarkup:
+    kb = reply_kb_cache.get((sender_id, lang))
+    if kb is None:
+        kb = _build_kb_reply(sender_id, lang)
+        reply_kb_cache.put((sender_id, lang), kb)
+    return kb
+
+
+async def home_screen(user_id: int, lang: str = DEFAULT_LANG) -> tuple[str, InlineKeyboardMarkup]:
+    """Текст и клавиатура главного экрана; пересобираются, только если поменялась ссылка."""
+    link = await get_my_link(user_id)
+    cached = home_cache.get((user_id, lang))
+    if cached is not None and cached[0] == link:
+        return cached[1], cached[2]
+    text, kb = home_text(link, lang), _build_kb_home(link, lang)
+    home_cache.put((user_id, lang), (link, text, kb))
+    return text, kb
+
+
+async def kb_home(user_id: int, lang: str = DEFAULT_LANG) -> InlineKeyboardMarkup:
+    return (await home_screen(user_id, lang))[1]
+
+
+def home_text(link: str, lang: str) -> str:
+    return t(lang, "home", link_block=quote_link_block(link))
+
+
+def stats_series(series: list[tuple[str, int, int]]) -> str:
+    return "\n".join(f"<code>{day[8:10]}.{day[5:7]}</code>  {msgs} / {clicks}" for day, clicks, msgs in series)
+
+
+def stats_text(st: dict, link: str, lang: str) -> str:
+    return t(
+        lang,
+        "stats",
+        msgs_today=st["msgs_today"],
+        clicks_today=st["link_clicks_today"],
+        msgs_7d=st["msgs_7d"],
+        clicks_7d=st["link_clicks_7d"],
+        msgs_30d=st["msgs_30d"],
+        clicks_30d=st["link_clicks_30d"],
+        series=stats_series(st["series_7d"]),
+        msgs_total=st["msgs_total"],
+        clicks_total=st["link_clicks_total"],
+        link_block=quote_link_block(link),
     )
-    await bot.send_message(ADMIN_ID, msg)
+
+
+def _admin_entry_html(fu, tu, text: str) -> str:
+    if len(text) > ADMIN_ENTRY_MAX_CHARS:
+        text = text[:ADMIN_ENTRY_MAX_CHARS] + "…"
+    return (
+        f"От: {html.escape(format_user(fu))}\n"
+        f"Кому: {html.escape(format_user(tu))}\n"
+        f"Сообщение: {html.escape(text)}"
+    )
+
+
+class AdminDigest:
+    """
+    Копии сообщений для админа копятся в памяти и уходят одним сообщением
+    раз в interval секунд (или при max_entries). Длинные пачки режутся по 4096,
+    а если сообщений получается слишком много — отправляем файлом.
+    """
+
+    LIMIT = 4096
+
+    def __init__(self, chat_id: int, interval: float, max_entries: int, max_messages: int, instant: bool = False):
+        self.chat_id = chat_id
+        self.interval = interval
+        self.max_entries = max_entries
+        self.max_messages = max_messages
+        self.instant = instant
+        self._entries: list[tuple[int, int, str, int]] = []  # (from_id, to_id, text, ts)
+        self._full = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def add(self, from_id: int, to_id: int, text: str):
+        self._entries.append((from_id, to_id, text, int(time.time())))
+        if self.instant or len(self._entries) >= self.max_entries:
+            self._full.set()
+
+    def _chunks(self, header: str, entries: list[str]) -> list[str]:
+        chunks, cur = [], header
+        for e in entries:
+            if len(cur) + 2 + len(e) > self.LIMIT:
+                chunks.append(cur)
+                cur = e
+            else:
+                cur = cur + "\n\n" + e
+        chunks.append(cur)
+        return chunks
+
+    async def flush(self):
+        if not self._entries:
+            return
+        entries, self._entries = self._entries, []
+        self._full.clear()
+        rows = []
+        for from_id, to_id, text, ts in entries:
+            rows.append((await get_user(from_id), await get_user(to_id), text, ts))
+
+        header = f"🛡 <b>ADMIN LOG</b> ({len(rows)})"
+        chunks = self._chunks(header, [_admin_entry_html(fu, tu, text) for fu, tu, text, _ in rows])
+        if len(chunks) <= self.max_messages:
+            for chunk in chunks:
+                outbox.post(SendMessage(chat_id=self.chat_id, text=chunk), PRIO_ADMIN)
+            return
+
+        lines = []
+        for fu, tu, text, ts in rows:
+            when = datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+            lines.append(f"[{when}] {format_user(fu)} -> {format_user(tu)}\n{text}\n")
+        doc = BufferedInputFile(
+            "\n".join(lines).encode("utf-8"),
+            filename=f"admin-log-{entries[0][3]}.txt",
+        )
+        outbox.post(
+            SendDocument(chat_id=self.chat_id, document=doc, caption=f"🛡 <b>ADMIN LOG</b>: {len(rows)} сообщений"),
+            PRIO_ADMIN,
+        )
+
+    async def _run(self):
+        while True:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("admin digest flush failed")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+
+admin_digest = AdminDigest(
+    ADMIN_ID,
+    interval=ADMIN_DIGEST_SECONDS,
+    max_entries=ADMIN_DIGEST_MAX_ENTRIES,
+    max_messages=ADMIN_DIGEST_MAX_MESSAGES,
+    instant=ADMIN_LOG_MODE == "instant",
+)
+
+
+def send_admin_log(from_id: int, to_id: int, text: str):
+    admin_digest.add(from_id, to_id, text)
+
+
+# =========================
+# ANTI-FLOOD
+# =========================
+def _flood_limit(value: str) -> tuple[float, float]:
+    rate, _, burst = value.partition(":")
+    return float(rate), float(burst or rate)
+
+
+class AntiFlood(BaseMiddleware):
+    """
+    Outer-middleware на update, стоит перед ChatExecutor: лишние апдейты
+    отбрасываются до очереди, базы и API. Token bucket'ы в памяти:
+    на отправителя (сообщения и кнопки), на пару отправитель→получатель
+    и на получателя (для сообщений, которые сейчас уйдут анонимно).
+    """
+
+    def __init__(self, sender: tuple[float, float], pair: tuple[float, float],
+                 recipient: tuple[float, float], max_keys: int = 100_000):
+        self.limits = {"sender": sender, "pair": pair, "recipient": recipient}
+        self._buckets = {kind: LRUCache(max_keys) for kind in self.limits}
+        self.rejected = {kind: 0 for kind in self.limits}
+        self._answers: set[asyncio.Task] = set()
+
+    def _take(self, kind: str, key) -> bool:
+        buckets = self._buckets[kind]
+        b = buckets.get(key)
+        if b is None:
+            b = TokenBucket(*self.limits[kind])
+            buckets.put(key, b)
+        if b.try_take():
+            return True
+        self.rejected[kind] += 1
+        return False
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.id == ADMIN_ID:
+            return await handler(event, data)
+        if not self._take("sender", user.id):
+            if event.callback_query is not None:
+                self._release_button(event.callback_query)
+            return None
+        if event.message is not None:
+            p = pending.get(user.id)
+            if p is not None:
+                to_id = p["to_id"]
+                if not self._take("pair", (user.id, to_id)) or not self._take("recipient", to_id):
+                    return None
+        return await handler(event, data)
+
+    def _release_button(self, query: CallbackQuery):
+        # без ответа у пользователя крутится индикатор на кнопке до таймаута Telegram.
+        # answerCallbackQuery не входит в лимиты отправки — шлём мимо outbox и не ждём
+        task = asyncio.ensure_future(query.answer())
+        self._answers.add(task)
+        task.add_done_callback(self._answered)
+
+    def _answered(self, task: asyncio.Task):
+        self._answers.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.debug("anti-flood: answerCallbackQuery failed: %r", task.exception())
+
+    def stats(self) -> dict:
+        return dict(self.rejected)
+
+
+antiflood = AntiFlood(
+    sender=_flood_limit(FLOOD_SENDER),
+    pair=_flood_limit(FLOOD_PAIR),
+    recipient=_flood_limit(FLOOD_RECIPIENT),
+)
+# регистрируется раньше executor — значит, и выполняется раньше
+dp.update.outer_middleware(antiflood)
+
+
+# =========================
+# UPDATE EXECUTOR
+# =========================
+class ChatExecutor(BaseMiddleware):
+    """
+    Outer-middleware на update: апдейты разных чатов обрабатываются параллельно
+    пулом из workers задач, апдейты одного чата — строго по очереди.
+    В работе не больше max_pending апдейтов, дальше feed_update ждёт свободного
+    места — это и есть backpressure для polling/webhook.
+    """
+
+    def __init__(self, workers: int = 16, max_pending: int = 1000):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._chats: dict[int, deque] = {}  # чат есть в словаре, пока у него есть работа
+        self._ready: asyncio.Queue | None = None
+        self._slots: asyncio.Semaphore | None = None
+        self._idle: asyncio.Event | None = None
+        self._tasks: list[asyncio.Task] = []
+        self.pending = 0
+        self.processed = 0
+        self.failed = 0
+
+    async def __call__(self, handler, event, data):
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        key = chat.id if chat is not None else user.id if user is not None else None
+        if key is None or not self._tasks:
+            return await handler(event, data)
+
+        await self._slots.acquire()
+        self.pending += 1
+        self._idle.clear()
+        q = self._chats.get(key)
+        if q is None:
+            self._chats[key] = deque([(handler, event, data)])
+            self._ready.put_nowait(key)
+        else:
+            q.append((handler, event, data))
+        return None
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            q = self._chats[key]
+            handler, event, data = q.popleft()
+            try:
+                await handler(event, data)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                log.exception("update handler failed (chat %s)", key)
+            finally:
+                self.pending -= 1
+                self._slots.release()
+                if q:
+                    self._ready.put_nowait(key)  # в конец очереди — чтобы один чат не занимал воркер
+                else:
+                    del self._chats[key]
+                    if not self._chats:
+                        self._idle.set()
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "chats": len(self._chats),
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+    async def join(self):
+        if self._idle is not None:
+            await self._idle.wait()
+
+    def start(self):
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 30):
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self.join(), timeout)
+        for t in self._tasks:
+            t.cancel()
+        for t in self._tasks:
+            with suppress(asyncio.CancelledError):
+                await t
+        self._tasks = []
+
+
+executor = ChatExecutor(workers=UPDATE_WORKERS, max_pending=UPDATE_MAX_PENDING)
+dp.update.outer_middleware(executor)
 
 
 # =========================
@@ -304,13 +2594,12 @@ async def send_admin_log(from_id: int, to_id: int, text: str):
 # =========================
 @dp.message(CommandStart())
 async def start(message: Message):
-    init_db()
-
-    code = upsert_user(
+    code = await upsert_user(
         message.from_user.id,
         message.from_user.username or "",
         message.from_user.full_name or "",
     )
+    lang = await user_lang(message.from_user.id)
 
     # deep-link: /start CODE
     parts = (message.text or "").split(maxsplit=1)
@@ -318,25 +2607,19 @@ async def start(message: Message):
 
     # если пришли по чужой ссылке -> ставим pending и просим написать сообщение
     if target_code:
-        target = get_user_by_code(target_code)
+        target = await get_user_by_code(target_code)
         if target and int(target["user_id"]) != message.from_user.id:
-            inc_click(int(target["user_id"]))
+            await inc_click(int(target["user_id"]))
             set_pending(message.from_user.id, int(target["user_id"]))
-            await message.answer("✍️ Напишите ваше сообщение — оно будет отправлено анонимно.")
+            await outbox.send(message.answer(t(lang, "write_prompt")))
             return
 
     # обычный /start (только тут предупреждение)
-    me = await bot.get_me()
-    link = f"https://t.me/{me.username}?start={code}"
-
-    text = (
-        "Начните получать анонимные вопросы прямо сейчас!\n\n"
-        "Ваша ссылка:\n"
-        f"{quote_link_block(link)}\n\n"
-        "Разместите эту ссылку ☝️ в описании своего профиля Telegram, TikTok, Instagram (stories), "
-        "чтобы вам могли написать 💬\n\n"
-    )
-    await message.answer(text, reply_markup=await kb_home(message.from_user.id))
+    await identity.ensure()
+    identity.remember(message.from_user.id, code)
+
+    text, kb = await home_screen(message.from_user.id, lang)
+    await outbox.send(message.answer(text, reply_markup=kb))
 
 
 # =========================
@@ -345,15 +2628,9 @@ async def start(message: Message):
 # =========================
 @dp.callback_query(F.data == "ui:home")
 async def ui_home(call: CallbackQuery):
-    link = await get_my_link(call.from_user.id)
-    text = (
-        "Начните получать анонимные вопросы прямо сейчас!\n\n"
-        "Ваша ссылка:\n"
-        f"{quote_link_block(link)}\n\n"
-        "Разместите эту ссылку ☝️ в описании своего профиля Telegram, TikTok, Instagram (stories), "
-        "чтобы вам могли написать 💬"
-    )
-    await call.message.edit_text(text, reply_markup=await kb_home(call.from_user.id))
+    lang = await user_lang(call.from_user.id)
+    text, kb = await home_screen(call.from_user.id, lang)
+    await outbox.send(call.message.edit_text(text, reply_markup=kb))
     await call.answer()
 
 
@@ -361,70 +2638,55 @@ async def ui_home(call: CallbackQuery):
 async def reply_start(call: CallbackQuery):
     sender_id = int(call.data.split(":")[1])
     set_pending(call.from_user.id, sender_id)
-    await call.message.answer("✍️ Напишите ответ — он будет отправлен анонимно.")
+    lang = await user_lang(call.from_user.id)
+    await outbox.send(call.message.answer(t(lang, "reply_prompt")))
     await call.answer()
 
 
 @dp.callback_query(F.data == "ui:stats")
 async def ui_stats(call: CallbackQuery):
-    st = get_stats(call.from_user.id)
+    lang = await user_lang(call.from_user.id)
+    st = await get_stats(call.from_user.id)
     link = await get_my_link(call.from_user.id)
 
-    text = (
-        "📊 <b>Статистика</b>\n\n"
-        f"Сегодня:\n"
-        f"💬 Сообщений: <b>{st['msgs_today']}</b>\n"
-        f"👀 Переходов по ссылке: <b>{st['link_clicks_today']}</b>\n\n"
-        f"За всё время:\n"
-        f"💬 Сообщений: <b>{st['msgs_total']}</b>\n"
-        f"👀 Переходов по ссылке: <b>{st['link_clicks_total']}</b>\n\n"
-        "Ваша ссылка:\n"
-        f"{quote_link_block(link)}"
-    )
-    await call.message.edit_text(text, reply_markup=kb_back_home())
+    text = stats_text(st, link, lang)
+    await outbox.send(call.message.edit_text(text, reply_markup=kb_back_home(lang)))
     await call.answer()
 
 
 @dp.callback_query(F.data == "ui:help")
 async def ui_help(call: CallbackQuery):
-    text = (
-        "ℹ️ <b>Помощь</b>\n\n"
-        "Как получать сообщения:\n"
-        "1) Нажмите /start и возьмите свою ссылку.\n"
-        "2) Разместите ссылку в профиле/сторис.\n\n"
-        "Как написать человеку:\n"
-        "— откройте его ссылку и отправьте сообщение/фото/стикер/файл.\n\n"
-        "Команды:\n"
-        "/start — старт\n"
-        "/url — ваша ссылка\n"
-        "/stats — статистика\n"
-        "/help — помощь"
-    )
-    await call.message.edit_text(text, reply_markup=kb_back_home())
+    lang = await user_lang(call.from_user.id)
+    await outbox.send(call.message.edit_text(t(lang, "help_ui"), reply_markup=kb_back_home(lang)))
     await call.answer()
 
 
 @dp.callback_query(F.data == "ui:lang")
 async def ui_lang(call: CallbackQuery):
-    await call.message.edit_text("🌍 <b>Выберите язык:</b>", reply_markup=kb_lang())
+    lang = await user_lang(call.from_user.id)
+    await outbox.send(call.message.edit_text(t(lang, "lang_choose"), reply_markup=kb_lang(lang)))
     await call.answer()
 
 
 @dp.callback_query(F.data.startswith("lang:"))
 async def ui_lang_set(call: CallbackQuery):
     lang = call.data.split(":", 1)[1]
-    set_lang(call.from_user.id, lang)
-    await call.answer("✅ Готово")
+    if lang not in TEXTS:
+        await call.answer()
+        return
+    await set_lang(call.from_user.id, lang)
+    await call.answer(t(lang, "lang_done"))
     await ui_home(call)
 
 
 @dp.callback_query(F.data == "ui:write_more")
 async def ui_write_more(call: CallbackQuery):
+    lang = await user_lang(call.from_user.id)
     p = get_pending(call.from_user.id)
     if p:
-        await call.message.answer("✍️ Напишите сообщение — оно будет отправлено анонимно.")
+        await outbox.send(call.message.answer(t(lang, "write_more_prompt")))
     else:
-        await call.message.answer("Откройте ссылку человека (t.me/бот?start=код), чтобы написать ему.")
+        await outbox.send(call.message.answer(t(lang, "write_more_none")))
     await call.answer()
 
 
@@ -433,184 +2695,868 @@ async def ui_write_more(call: CallbackQuery):
 # =========================
 @dp.message(Command("stats"))
 async def cmd_stats(message: Message):
-    st = get_stats(message.from_user.id)
+    lang = await user_lang(message.from_user.id)
+    st = await get_stats(message.from_user.id)
     link = await get_my_link(message.from_user.id)
-    text = (
-        "📊 <b>Статистика</b>\n\n"
-        f"Сегодня:\n"
-        f"💬 Сообщений: <b>{st['msgs_today']}</b>\n"
-        f"👀 Переходов по ссылке: <b>{st['link_clicks_today']}</b>\n\n"
-        f"За всё время:\n"
-        f"💬 Сообщений: <b>{st['msgs_total']}</b>\n"
-        f"👀 Переходов по ссылке: <b>{st['link_clicks_total']}</b>\n\n"
-        "Ваша ссылка:\n"
-        f"{quote_link_block(link)}"
-    )
-    await message.answer(text, reply_markup=await kb_home(message.from_user.id))
+    text = stats_text(st, link, lang)
+    await outbox.send(message.answer(text, reply_markup=await kb_home(message.from_user.id, lang)))
 
 
 @dp.message(Command("url"))
 async def cmd_url(message: Message):
+    lang = await user_lang(message.from_user.id)
     link = await get_my_link(message.from_user.id)
-    await message.answer("Ваша ссылка:\n" + quote_link_block(link))
+    await outbox.send(message.answer(t(lang, "url", link_block=quote_link_block(link))))
 
 
 @dp.message(Command("help"))
 async def cmd_help(message: Message):
-    await message.answer(
-        "ℹ️ <b>Помощь</b>\n\n"
-        "Как получать сообщения:\n"
-        "1) /start → возьмите ссылку.\n"
-        "2) Разместите ссылку.\n\n"
-        "Что можно отправлять:\n"
-        "Текст, фото, стикеры, файлы.\n\n"
-        "Команды:\n"
-        "/start — старт\n"
-        "/url — ваша ссылка\n"
-        "/stats — статистика\n"
-        "/help — помощь"
-    )
+    lang = await user_lang(message.from_user.id)
+    await outbox.send(message.answer(t(lang, "help_cmd")))
+
+
+def _log_user(r, prefix: str) -> dict | None:
+    if r[f"{prefix}_username"] is None and r[f"{prefix}_full_name"] is None:
+        return None
+    return {
+        "user_id": r[f"{prefix}_id"],
+        "username": r[f"{prefix}_username"],
+        "full_name": r[f"{prefix}_full_name"],
+    }
+
+
+def _parse_admin_filter(args: str) -> tuple[int | None, int | None]:
+    from_id = to_id = None
+    for part in args.split():
+        key, _, value = part.partition(":")
+        if key == "from" and value.isdigit():
+            from_id = int(value)
+        elif key == "to" and value.isdigit():
+            to_id = int(value)
+    return from_id, to_id
+
+
+async def render_admin_page(before: int | None = None, after: int | None = None,
+                            from_id: int | None = None, to_id: int | None = None):
+    rows = await logs_page(before, after, from_id, to_id, limit=ADMIN_PAGE_SIZE + 1)
+    # лишняя строка — признак, что в этом направлении есть ещё страница
+    more = len(rows) > ADMIN_PAGE_SIZE
+    if more:
+        rows = rows[1:] if after is not None else rows[:-1]
+    if not rows:
+        return "Логов пока нет.", None
+
+    # набираем строки от курсора: при листании к новым он снизу страницы
+    shown, lines, size = [], [], 0
+    for r in (reversed(rows) if after is not None else rows):
+        text = r["text"]
+        if len(text) > ADMIN_PAGE_TEXT_CHARS:
+            text = text[:ADMIN_PAGE_TEXT_CHARS] + "…"
+        line = (
+            f"— {html.escape(format_user(_log_user(r, 'from')))} → "
+            f"{html.escape(format_user(_log_user(r, 'to')))}: {html.escape(text)}"
+        )
+        size += len(line) + 1
+        if size > 3900 and lines:  # лимит сообщения 4096 — остаток на следующей странице
+            more = True
+            break
+        shown.append(r)
+        lines.append(line)
+    if after is not None:
+        shown.reverse()
+        lines.reverse()
+    lines.insert(0, "🛡 <b>Последние сообщения</b>:")
+
+    f_id, t_id = from_id or 0, to_id or 0
+    newest, oldest = shown[0]["id"], shown[-1]["id"]
+    has_newer = (after is not None and more) or (after is None and before is not None)
+    has_older = (after is None and more) or after is not None
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton(text="◀️ Новее", callback_data=f"adm:after:{newest}:{f_id}:{t_id}"))
+    if has_older:
+        nav.append(InlineKeyboardButton(text="Старее ▶️", callback_data=f"adm:before:{oldest}:{f_id}:{t_id}"))
+    kb = InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+    return "\n".join(lines), kb
 
 
 @dp.message(Command("admin"))
-async def cmd_admin(message: Message):
+async def cmd_admin(message: Message, command: CommandObject):
     if message.from_user.id != ADMIN_ID:
         return
-    rows = last_logs(25)
+    from_id, to_id = _parse_admin_filter(command.args or "")
+    text, kb = await render_admin_page(from_id=from_id, to_id=to_id)
+    await outbox.send(message.answer(text, reply_markup=kb))
+
+
+# callback_data ограничена 64 байтами, поэтому в кнопках только короткий id запроса.
+# qid -> (запрос, {начало страницы: начало предыдущей}) — страницы бывают короче
+# ADMIN_PAGE_SIZE (лимит длины сообщения), и «Назад» берёт точное начало оттуда
+search_queries = LRUCache(256)
+
+
+async def render_search_page(qid: str, query: str, prev_pages: dict[int, int], offset: int):
+    try:
+        rows = await search_logs(fts_query(query), offset, limit=ADMIN_PAGE_SIZE + 1)
+    except sqlite3.OperationalError:
+        return "Не удалось разобрать запрос.", None
+    more = len(rows) > ADMIN_PAGE_SIZE
+    rows = rows[:ADMIN_PAGE_SIZE]
     if not rows:
-        await message.answer("Логов пока нет.")
-        return
-    lines = ["🛡 <b>Последние сообщения</b>:"]
+        return f"🔎 По запросу «{html.escape(query)}» ничего не найдено.", None
+
+    lines, size = [], 0
     for r in rows:
-        fu = get_user(r["from_id"])
-        tu = get_user(r["to_id"])
-        lines.append(f"— {format_user(fu)} → {format_user(tu)}: {r['text']}")
-    await message.answer("\n".join(lines))
+        snippet = r["snippet"]
+        if len(snippet) > ADMIN_PAGE_TEXT_CHARS:
+            snippet = snippet[:ADMIN_PAGE_TEXT_CHARS] + "…"
+        snippet = html.escape(snippet).replace("\x02", "<b>").replace("\x03", "</b>")
+        if snippet.count("<b>") > snippet.count("</b>"):
+            snippet += "</b>"  # обрезали посреди выделения
+        when = datetime.utcfromtimestamp(r["created_at"]).strftime("%Y-%m-%d %H:%M")
+        line = (
+            f"— {when} {html.escape(format_user(_log_user(r, 'from')))} → "
+            f"{html.escape(format_user(_log_user(r, 'to')))}: {snippet}"
+        )
+        size += len(line) + 1
+        if size > 3900 and lines:  # лимит сообщения 4096 — остаток на следующей странице
+            more = True
+            break
+        lines.append(line)
+    lines.insert(0, f"🔎 <b>{html.escape(query)}</b> — {offset + 1}–{offset + len(lines)}:")
+    next_offset = offset + len(lines) - 1
+
+    nav = []
+    if offset:
+        prev = prev_pages.get(offset, max(0, offset - ADMIN_PAGE_SIZE))
+        nav.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"srch:{qid}:{prev}"))
+    if more:
+        prev_pages[next_offset] = offset
+        nav.append(InlineKeyboardButton(text="Дальше ▶️", callback_data=f"srch:{qid}:{next_offset}"))
+    kb = InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+    return "\n".join(lines), kb
+
+
+@dp.message(Command("search"))
+async def cmd_search(message: Message, command: CommandObject):
+    if message.from_user.id != ADMIN_ID:
+        return
+    query = (command.args or "").strip()
+    if not fts_query(query):
+        await outbox.send(message.answer(
+            "🔎 /search слова — поиск по логам\n"
+            "\"точная фраза\" — в кавычках, слово* — по началу слова"
+        ))
+        return
+    qid = secrets.token_urlsafe(6)
+    prev_pages: dict[int, int] = {}
+    search_queries.put(qid, (query, prev_pages))
+    text, kb = await render_search_page(qid, query, prev_pages, 0)
+    await outbox.send(message.answer(text, reply_markup=kb))
+
+
+@dp.callback_query(F.data.startswith("srch:"))
+async def search_page(call: CallbackQuery):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    _, qid, offset = call.data.split(":")
+    entry = search_queries.get(qid)
+    if entry is None:
+        await call.answer("Поиск устарел — повторите /search", show_alert=True)
+        return
+    query, prev_pages = entry
+    text, kb = await render_search_page(qid, query, prev_pages, int(offset))
+    await outbox.send(call.message.edit_text(text, reply_markup=kb))
+    await call.answer()
+
+
+@dp.callback_query(F.data.startswith("adm:"))
+async def admin_page(call: CallbackQuery):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    _, direction, cursor, f_id, t_id = call.data.split(":")
+    cursor = int(cursor)
+    text, kb = await render_admin_page(
+        before=cursor if direction == "before" else None,
+        after=cursor if direction == "after" else None,
+        from_id=int(f_id) or None,
+        to_id=int(t_id) or None,
+    )
+    await outbox.send(call.message.edit_text(text, reply_markup=kb))
+    await call.answer()
+
+
+# =========================
+# BROADCAST
+# =========================
+def _broadcast_checkpoint(con: sqlite3.Connection, bid: int, last_user_id: int,
+                          sent: int, failed: int, blocked_ids: list[int]):
+    now = int(time.time())
+    con.executemany("UPDATE users SET blocked_at=? WHERE user_id=?", [(now, uid) for uid in blocked_ids])
+    con.execute(
+        "UPDATE broadcasts SET last_user_id=?, sent=sent+?, failed=failed+?, blocked=blocked+? WHERE id=?",
+        (last_user_id, sent, failed, len(blocked_ids), bid),
+    )
+
+
+def _broadcast_create(con: sqlite3.Connection, text: str | None, from_chat_id: int | None,
+                      message_id: int | None, status_chat_id: int, status_message_id: int) -> int:
+    total = con.execute("SELECT COUNT(*) FROM users WHERE blocked_at IS NULL").fetchone()[0]
+    return con.execute(
+        "INSERT INTO broadcasts (text, from_chat_id, message_id, total, status_chat_id, status_message_id, created_at) "
+        "VALUES (?,?,?,?,?,?,?)",
+        (text, from_chat_id, message_id, total, status_chat_id, status_message_id, int(time.time())),
+    ).lastrowid
+
+
+class Broadcaster:
+    """
+    Рассылка всем пользователям: user_id читаются из базы пачками по chunk (по курсору),
+    отправка — через outbox с низким приоритетом и своим лимитом rate msg/s,
+    после каждой пачки прогресс сохраняется в broadcasts. После рестарта рассылка
+    продолжается с last_user_id (пачка, прерванная на середине, уйдёт повторно).
+    Заблокировавшие бота помечаются users.blocked_at и дальше пропускаются.
+    """
+
+    def __init__(self, rate: float, chunk: int = 200, report_every: float = 5):
+        self.bucket = TokenBucket(rate, rate)
+        self.chunk = chunk
+        self.report_every = report_every
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def _method(self, b, user_id: int):
+        if b["text"] is not None:
+            return SendMessage(chat_id=user_id, text=b["text"])
+        return CopyMessage(chat_id=user_id, from_chat_id=b["from_chat_id"], message_id=b["message_id"])
+
+    async def _send_one(self, b, user_id: int) -> str:
+        await self.bucket.acquire()
+        try:
+            await outbox.send(self._method(b, user_id), PRIO_BULK)
+            return "sent"
+        except TelegramForbiddenError:
+            return "blocked"
+        except TelegramBadRequest as e:
+            # "chat not found" / удалённый аккаунт — тоже больше не слать
+            return "blocked" if "chat not found" in str(e).lower() else "failed"
+        except Exception:
+            return "failed"
+
+    def _report(self, b, sent: int, failed: int, blocked: int, started: float, done_at_start: int,
+                      final: str | None = None):
+        done = sent + failed + blocked
+        elapsed = max(time.monotonic() - started, 1e-6)
+        speed = (done - done_at_start) / elapsed
+        left = max(b["total"] - done, 0)
+        eta = f"{int(left / speed) // 60}:{int(left / speed) % 60:02d}" if speed > 0 and left else "0:00"
+        text = (
+            f"📣 <b>Рассылка #{b['id']}</b>{' — ' + final if final else ''}\n"
+            f"Отправлено: <b>{sent}</b>, ошибок: <b>{failed}</b>, заблокировали бота: <b>{blocked}</b>\n"
+            f"Прогресс: {done}/{b['total']} · {speed:.1f} msg/s · ETA {eta}"
+        )
+        if b["status_message_id"]:
+            outbox.post(EditMessageText(
+                chat_id=b["status_chat_id"], message_id=b["status_message_id"], text=text,
+            ), PRIO_ADMIN)
+
+    async def _run(self, bid: int):
+        b = await store.fetchone("SELECT * FROM broadcasts WHERE id=?", (bid,))
+        last = b["last_user_id"]
+        sent, failed, blocked = b["sent"], b["failed"], b["blocked"]
+        started, done_at_start, reported = time.monotonic(), sent + failed + blocked, time.monotonic()
+        while True:
+            rows = await store.fetchall(
+                "SELECT user_id FROM users WHERE user_id>? AND blocked_at IS NULL ORDER BY user_id LIMIT ?",
+                (last, self.chunk),
+            )
+            if not rows:
+                break
+            ids = [r["user_id"] for r in rows]
+            results = await asyncio.gather(*(self._send_one(b, uid) for uid in ids))
+            blocked_ids = [uid for uid, r in zip(ids, results) if r == "blocked"]
+            n_sent, n_failed = results.count("sent"), results.count("failed")
+            last = ids[-1]
+            await store.write(_broadcast_checkpoint, bid, last, n_sent, n_failed, blocked_ids)
+            for uid in blocked_ids:
+                u = user_cache.get(uid)
+                if u is not None:
+                    user_cache.put(uid, {**u, "blocked_at": int(time.time())})
+            sent, failed, blocked = sent + n_sent, failed + n_failed, blocked + len(blocked_ids)
+            if time.monotonic() - reported >= self.report_every:
+                reported = time.monotonic()
+                self._report(b, sent, failed, blocked, started, done_at_start)
+
+        await store.execute(
+            "UPDATE broadcasts SET status='done', finished_at=? WHERE id=?",
+            (int(time.time()), bid),
+        )
+        self._report(b, sent, failed, blocked, started, done_at_start, final="готово")
+        log.info("broadcast %s done: sent=%s failed=%s blocked=%s", bid, sent, failed, blocked)
+
+    def _spawn(self, bid: int):
+        task = asyncio.create_task(self._run(bid))
+        self._tasks[bid] = task
+        task.add_done_callback(lambda _: self._tasks.pop(bid, None))
+
+    async def create(self, text: str | None, from_chat_id: int | None, message_id: int | None,
+                     status_chat_id: int) -> int:
+        status = await outbox.send(SendMessage(chat_id=status_chat_id, text="📣 Рассылка запускается…"), PRIO_ADMIN)
+        bid = await store.write(
+            _broadcast_create, text, from_chat_id, message_id, status_chat_id, status.message_id,
+        )
+        self._spawn(bid)
+        return bid
+
+    async def cancel(self) -> list[int]:
+        await store.execute("UPDATE broadcasts SET status='cancelled', finished_at=? WHERE status='running'",
+                            (int(time.time()),))
+        ids = list(self._tasks)
+        for bid in ids:
+            self._tasks[bid].cancel()
+        return ids
+
+    async def resume(self):
+        rows = await store.fetchall("SELECT id FROM broadcasts WHERE status='running'")
+        for r in rows:
+            if r["id"] not in self._tasks:
+                log.info("resuming broadcast %s", r["id"])
+                self._spawn(r["id"])
+
+    async def stop(self):
+        # статус остаётся running — после рестарта продолжим с последней контрольной точки
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with suppress(asyncio.CancelledError):
+                await task
+
+
+broadcaster = Broadcaster(rate=BROADCAST_RATE, chunk=BROADCAST_CHUNK)
+
+
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: Message, command: CommandObject):
+    if message.from_user.id != ADMIN_ID:
+        return
+    args = (command.args or "").strip()
+    if args == "stop":
+        ids = await broadcaster.cancel()
+        await outbox.send(message.answer(f"⛔️ Остановлено: {', '.join(f'#{i}' for i in ids) or 'нет активных'}"))
+        return
+    if message.reply_to_message is not None:
+        src_msg = message.reply_to_message
+        await broadcaster.create(None, src_msg.chat.id, src_msg.message_id, message.chat.id)
+    elif args:
+        await broadcaster.create(args, None, None, message.chat.id)
+    else:
+        await outbox.send(message.answer(
+            "📣 /broadcast текст — разослать всем\n"
+            "или ответьте /broadcast на сообщение, чтобы разослать его копию\n"
+            "/broadcast stop — остановить"
+        ))
+
+
+# =========================
+# EXPORT
+# =========================
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # больше Bot API не примет
+EXPORT_COLUMNS = {
+    "logs": ("id", "created_at", "from_id", "from_username", "from_full_name",
+             "to_id", "to_username", "to_full_name", "text"),
+    "stats": ("user_id", "day", "link_clicks", "msgs"),
+}
+EXPORT_FORMATS = ("csv", "jsonl")
+
+
+def _utc_day_ts(day: str) -> int:
+    return int(datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp())
+
+
+def _export_chunks(con: sqlite3.Connection, kind: str, day_from: str, day_to: str, chunk: int):
+    """Строки пачками по курсору — каждая пачка отдельным запросом, без долгой транзакции чтения."""
+    if kind == "logs":
+        start = _utc_day_ts(day_from) if day_from else 0
+        end = _utc_day_ts(day_to) + 86400 if day_to else 1 << 62
+        sql = (
+            "SELECT l.id, strftime('%Y-%m-%d %H:%M:%S', l.created_at, 'unixepoch') AS created_at, "
+            "l.from_id, fu.username AS from_username, fu.full_name AS from_full_name, "
+            "l.to_id, tu.username AS to_username, tu.full_name AS to_full_name, l.text "
+            "FROM logs l "
+            "LEFT JOIN users fu ON fu.user_id=l.from_id "
+            "LEFT JOIN users tu ON tu.user_id=l.to_id "
+            "WHERE l.id>? AND l.created_at>=? AND l.created_at<? ORDER BY l.id LIMIT ?"
+        )
+        last = 0
+        while rows := con.execute(sql, (last, start, end, chunk)).fetchall():
+            yield rows
+            last = rows[-1]["id"]
+    else:
+        sql = (
+            "SELECT user_id, day, link_clicks, msgs FROM stats_daily "
+            "WHERE (user_id, day)>(?, ?) AND day>=? AND day<=? ORDER BY user_id, day LIMIT ?"
+        )
+        last = (0, "")
+        while rows := con.execute(sql, (*last, day_from, day_to or "9999-12-31", chunk)).fetchall():
+            yield rows
+            last = (rows[-1]["user_id"], rows[-1]["day"])
+
+
+def _write_export(con: sqlite3.Connection, path: str, kind: str, fmt: str,
+                  day_from: str, day_to: str, chunk: int) -> int:
+    columns = EXPORT_COLUMNS[kind]
+    total = 0
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f) if fmt == "csv" else None
+        if writer is not None:
+            writer.writerow(columns)
+        for rows in _export_chunks(con, kind, day_from, day_to, chunk):
+            if writer is not None:
+                writer.writerows(tuple(r) for r in rows)
+            else:
+                f.writelines(json.dumps(dict(r), ensure_ascii=False) + "\n" for r in rows)
+            total += len(rows)
+    return total
+
+
+async def export_to_file(kind: str, fmt: str, day_from: str = "", day_to: str = "") -> tuple[str, int]:
+    """Пишет выгрузку во временный .gz на диске; в памяти не больше одной пачки. Возвращает (путь, строк)."""
+    await write_behind.flush()
+    fd, path = tempfile.mkstemp(prefix=f"export-{kind}-", suffix=f".{fmt}.gz")
+    os.close(fd)
+    try:
+        total = await store.read(_write_export, path, kind, fmt, day_from, day_to, EXPORT_CHUNK)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path, total
+
+
+def _parse_export_args(args: str) -> tuple[str, str, str, str]:
+    kind, fmt, day_from, day_to = "", "csv", "", ""
+    for part in args.split():
+        key, _, value = part.partition(":")
+        if part in EXPORT_COLUMNS:
+            kind = part
+        elif part in EXPORT_FORMATS:
+            fmt = part
+        elif key in ("from", "to"):
+            datetime.strptime(value, "%Y-%m-%d")  # ValueError, если дата кривая
+            if key == "from":
+                day_from = value
+            else:
+                day_to = value
+        else:
+            raise ValueError(part)
+    if not kind:
+        raise ValueError("kind")
+    return kind, fmt, day_from, day_to
+
+
+export_lock = asyncio.Lock()
+
+
+@dp.message(Command("export"))
+async def cmd_export(message: Message, command: CommandObject):
+    if message.from_user.id != ADMIN_ID:
+        return
+    try:
+        kind, fmt, day_from, day_to = _parse_export_args(command.args or "")
+    except ValueError:
+        await outbox.send(message.answer(
+            "📦 /export logs|stats [from:ГГГГ-ММ-ДД] [to:ГГГГ-ММ-ДД] [csv|jsonl]\n"
+            "Даты по UTC, обе включительно."
+        ))
+        return
+    if export_lock.locked():
+        await outbox.send(message.answer("⏳ Предыдущая выгрузка ещё готовится."))
+        return
+    async with export_lock:
+        await outbox.send(message.answer("⏳ Готовлю выгрузку…"))
+        try:
+            path, total = await export_to_file(kind, fmt, day_from, day_to)
+        except (sqlite3.Error, OSError):
+            log.exception("export %s failed", kind)
+            await outbox.send(message.answer("Не удалось подготовить выгрузку — подробности в логах."))
+            return
+        try:
+            size = os.path.getsize(path)
+            if size > EXPORT_MAX_BYTES:
+                await outbox.send(message.answer(
+                    f"Файл вышел {size // (1024 * 1024)} МБ — больше лимита Telegram. Сузьте диапазон дат."
+                ))
+                return
+            name = f"{kind}_{day_from or 'start'}_{day_to or today_key()}.{fmt}.gz"
+            caption = f"📦 {kind}: {total} строк, {size // 1024 + 1} КБ"
+            oldest_kept = (datetime.utcnow() - timedelta(days=LOG_RETENTION_DAYS)).strftime("%Y-%m-%d")
+            if kind == "logs" and LOG_RETENTION_DAYS and day_from < oldest_kept:
+                caption += f"\nЛоги старше {LOG_RETENTION_DAYS} дн. — в архиве на сервере ({ARCHIVE_DIR})"
+            await outbox.send(SendDocument(
+                chat_id=message.chat.id,
+                document=FSInputFile(path, filename=name),
+                caption=caption,
+            ), PRIO_ADMIN)
+        finally:
+            os.unlink(path)
+
+
+# =========================
+# PERF (/metrics + /perf)
+# =========================
+CACHES = {
+    "users": user_cache,
+    "codes": code_cache,
+    "links": identity.links,
+    "home": home_cache,
+    "reply_kb": reply_kb_cache,
+}
+
+metrics.collect("bot_db_commits_total", "counter", "Committed write transactions", lambda: store.commits)
+metrics.collect("bot_cache_hits_total", "counter", "LRU cache hits", lambda: {k: c.hits for k, c in CACHES.items()}, "cache")
+metrics.collect("bot_cache_misses_total", "counter", "LRU cache misses", lambda: {k: c.misses for k, c in CACHES.items()}, "cache")
+metrics.collect("bot_cache_size", "gauge", "LRU cache entries", lambda: {k: len(c) for k, c in CACHES.items()}, "cache")
+metrics.collect("bot_outbox_depth", "gauge", "Queued outgoing requests", outbox.depth)
+metrics.collect("bot_outbox_inflight", "gauge", "Outgoing requests in flight", lambda: outbox.inflight)
+metrics.collect(
+    "bot_outbox_requests_total", "counter", "Outgoing requests by result",
+    lambda: {k: v for k, v in outbox.stats().items() if k in ("sent", "retried", "failed")}, "result",
+)
+metrics.collect("bot_executor_pending", "gauge", "Updates waiting in ChatExecutor", lambda: executor.pending)
+metrics.collect("bot_executor_chats", "gauge", "Chats with queued updates", lambda: executor.stats()["chats"])
+metrics.collect(
+    "bot_executor_updates_total", "counter", "Updates handled by ChatExecutor",
+    lambda: {"processed": executor.processed, "failed": executor.failed}, "result",
+)
+metrics.collect("bot_antiflood_rejected_total", "counter", "Updates dropped by anti-flood", antiflood.stats, "kind")
+metrics.collect("bot_write_behind_buffered", "gauge", "Rows waiting for the next flush", lambda: write_behind.stats()["buffered"])
+metrics.collect("bot_write_behind_flushes_total", "counter", "Write-behind flushes", lambda: write_behind.flushes)
+metrics.collect("bot_write_behind_rows_total", "counter", "Rows flushed by write-behind", lambda: write_behind.flushed)
+metrics.collect("bot_pending_windows", "gauge", "Open reply windows", lambda: len(pending))
+metrics.collect("bot_retention_archived_total", "counter", "Log rows moved to archive", lambda: retention.archived)
+
+
+def _perf_histograms(name: str, top: int = 10) -> list[str]:
+    series = sorted(metrics.histograms(name).items(), key=lambda kv: kv[1].sum, reverse=True)
+    return [
+        f"— {html.escape(' '.join(labels))}: {h.count}, "
+        f"p50 {h.quantile(0.5) * 1000:.1f} / p99 {h.quantile(0.99) * 1000:.1f} мс"
+        for labels, h in series[:top]
+    ]
+
+
+def perf_text() -> str:
+    uptime = int(time.time() - metrics.started)
+    updates = sorted(metrics.counters("bot_updates_total").items(), key=lambda kv: kv[1], reverse=True)
+    api_errors = sum(metrics.counters("bot_api_errors_total").values())
+    ob, ex, wb = outbox.stats(), executor.stats(), write_behind.stats()
+    lines = [f"📈 <b>Производительность</b> (аптайм {timedelta(seconds=uptime)})", "", "<b>Апдейты</b>:"]
+    lines += [f"— {':'.join(filter(None, labels))}: {int(n)}" for labels, n in updates[:10]]
+    lines += ["", "<b>Хендлеры</b> (вызовов, p50 / p99):"] + _perf_histograms("bot_handler_seconds")
+    lines += ["", f"<b>Bot API</b> (ошибок: {int(api_errors)}):"] + _perf_histograms("bot_api_seconds")
+    lines += ["", "<b>БД</b> (по суммарному времени):"] + _perf_histograms("bot_db_seconds")
+    lines += [
+        "",
+        f"<b>Outbox</b>: в очереди {ob['depth']} (макс. {ob['max_depth']}), в полёте {ob['inflight']}, "
+        f"отправлено {ob['sent']}, повторов {ob['retried']}, ошибок {ob['failed']}",
+        f"<b>Executor</b>: ждут {ex['pending']} в {ex['chats']} чатах, обработано {ex['processed']}, ошибок {ex['failed']}",
+        "<b>Анти-флуд</b>: " + ", ".join(f"{k} {v}" for k, v in antiflood.stats().items()),
+        f"<b>Write-behind</b>: в буфере {wb['buffered']}, сбросов {wb['flushes']}, строк {wb['flushed']}; "
+        f"коммитов {store.commits}",
+        f"<b>Retention</b>: в архиве {retention.archived}",
+        "<b>Обслуживание</b>: " + (", ".join(
+            f"{name} {elapsed:.2f} с ({int(time.time() - at) // 60} мин назад)"
+            for name, (at, elapsed, _) in maintenance.last.items()
+        ) or "ещё не запускалось"),
+        "<b>Кэши</b>: " + ", ".join(
+            f"{k} {c.hits * 100 // max(1, c.hits + c.misses)}% ({len(c)})" for k, c in CACHES.items()
+        ),
+    ]
+    return "\n".join(lines)
+
+
+@dp.message(Command("perf"))
+async def cmd_perf(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    await outbox.send(message.answer(perf_text()))
 
 
 # =========================
 # Message sending (TEXT/PHOTO/STICKER/DOC)
 # =========================
+# content_type -> (ключ заголовка для получателя, метка в логе).
+# Всё, кроме текста, пересылается одним copyMessage; стикеру и кружку подпись не добавить,
+# у них остаётся только кнопка «Ответить».
+RELAY_TYPES = {
+    "photo": ("anon_photo", "[photo]"),
+    "document": ("anon_document", "[document]"),
+    "video": ("anon_video", "[video]"),
+    "animation": ("anon_animation", "[animation]"),
+    "audio": ("anon_audio", "[audio]"),
+    "voice": ("anon_voice", "[voice]"),
+    "sticker": (None, "[sticker]"),
+    "video_note": (None, "[video_note]"),
+}
+
+ALBUM_MEDIA = {
+    "photo": lambda m: InputMediaPhoto(media=m.photo[-1].file_id),
+    "video": lambda m: InputMediaVideo(media=m.video.file_id),
+    "document": lambda m: InputMediaDocument(media=m.document.file_id),
+    "audio": lambda m: InputMediaAudio(media=m.audio.file_id),
+}
+
+
+def with_header(header: str, caption: str) -> str:
+    return (header + "\n\n" + html.escape(caption)) if caption else header
+
+
+async def after_relay(from_id: int, from_chat_id: int, to_id: int, log_text: str):
+    await inc_msg(to_id)
+
+    await log_message(from_id, to_id, log_text)
+    send_admin_log(from_id, to_id, log_text)
+
+    lang = await user_lang(from_id)
+    await outbox.send(SendMessage(chat_id=from_chat_id, text=t(lang, "sent"), reply_markup=kb_write_more(lang)))
+
+    # чтобы можно было писать дальше
+    set_pending(from_id, to_id)
+
+
+class AlbumCollector:
+    """
+    Альбом приходит N отдельными апдейтами с общим media_group_id.
+    Копим их, пока delay секунд не придёт новых, и отправляем одним sendMediaGroup.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._albums: dict[tuple[int, str], tuple[int, list[Message]]] = {}  # -> (to_id, части)
+        self._timers: dict[tuple[int, str], asyncio.TimerHandle] = {}
+        self._tasks: dict[tuple[int, str], asyncio.Task] = {}
+
+    def add(self, message: Message, to_id: int):
+        key = (message.from_user.id, message.media_group_id)
+        self._albums.setdefault(key, (to_id, []))[1].append(message)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        self._timers[key] = asyncio.get_running_loop().call_later(self.delay, self._fire, key)
+
+    def _fire(self, key: tuple[int, str]):
+        self._timers.pop(key, None)
+        task = asyncio.create_task(self._send(key))
+        self._tasks[key] = task
+        task.add_done_callback(lambda t: self._tasks.pop(key) if self._tasks.get(key) is t else None)
+
+    async def flush_sender(self, from_id: int, keep: str | None = None):
+        """
+        Отправляет альбомы отправителя (кроме media_group_id keep) и ждёт их —
+        иначе сообщение, пришедшее после альбома, обгонит его у получателя.
+        """
+        for key in [k for k in self._timers if k[0] == from_id and k[1] != keep]:
+            self._timers[key].cancel()
+            self._fire(key)
+        tasks = [task for key, task in self._tasks.items() if key[0] == from_id and key[1] != keep]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _send(self, key: tuple[int, str]):
+        to_id, messages = self._albums.pop(key)
+        messages.sort(key=lambda m: m.message_id)
+        first = messages[0]
+        media, caption = [], ""
+        for m in messages:
+            item = ALBUM_MEDIA[m.content_type](m)
+            if m.caption and m.caption.strip():
+                caption = caption or m.caption.strip()
+                item = item.model_copy(update={"caption": html.escape(m.caption.strip())})
+            media.append(item)
+        to_lang = await user_lang(to_id)
+        try:
+            await outbox.send(SendMediaGroup(chat_id=to_id, media=media), PRIO_RELAY)
+            # у альбома не бывает клавиатуры — кнопка «Ответить» идёт отдельным сообщением
+            await outbox.send(SendMessage(
+                chat_id=to_id,
+                text=t(to_lang, "anon_album", count=len(media)),
+                reply_markup=kb_reply(first.from_user.id, to_lang),
+            ), PRIO_RELAY)
+        except Exception:
+            log.exception("album relay failed")
+            lang = await user_lang(first.from_user.id)
+            await outbox.send(SendMessage(chat_id=first.chat.id, text=t(lang, "album_failed")))
+            return
+        await after_relay(first.from_user.id, first.chat.id, to_id, f"[album {len(media)}] " + caption)
+
+    async def stop(self):
+        # недособранные альбомы отправляем сразу, не дожидаясь таймера
+        for key, timer in list(self._timers.items()):
+            timer.cancel()
+            self._fire(key)
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+
+albums = AlbumCollector(ALBUM_DEBOUNCE_MS / 1000)
+
+
 @dp.message()
 async def on_message(message: Message):
-    init_db()
+    # собираемый альбом этого отправителя уходит раньше всего, что прислано после него
+    await albums.flush_sender(message.from_user.id, keep=message.media_group_id)
+    lang = await user_lang(message.from_user.id)
 
     code_from_link = extract_code_from_link(message.text or "")
     if code_from_link:
-        await message.answer("Открой эту ссылку (нажми на неё), затем напиши сообщение в боте.")
+        await outbox.send(message.answer(t(lang, "open_link_first")))
         return
 
     p = get_pending(message.from_user.id)
     if not p:
-        await message.answer("Чтобы написать человеку — открой его ссылку (t.me/бот?start=код).")
+        await outbox.send(message.answer(t(lang, "no_pending")))
         return
 
     if int(time.time()) - int(p["created_at"]) > TTL_SECONDS:
         clear_pending(message.from_user.id)
-        await message.answer("⏳ Время истекло. Открой ссылку человека заново.")
+        await outbox.send(message.answer(t(lang, "expired")))
         return
 
     to_id = int(p["to_id"])
 
     # если совсем пусто
-    if not (message.text or message.photo or message.sticker or message.document or message.video or message.voice):
-        await message.answer("Пустое сообщение не отправляю.")
+    if message.text is not None and not message.text.strip():
+        await outbox.send(message.answer(t(lang, "empty")))
         return
 
-    reply_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(
-            text="💬 Ответить",
-            callback_data=f"reply:{message.from_user.id}"
-        )]
-    ])
+    if message.media_group_id and message.content_type in ALBUM_MEDIA:
+        albums.add(message, to_id)
+        return
 
-    sent_any = False
-    log_text = ""
+    to_lang = await user_lang(to_id)
 
     # Текст
-    if message.text and message.text.strip():
+    if message.text:
         text = message.text.strip()
-        await bot.send_message(
-            to_id,
-            "📩 Вам пришло анонимное сообщение:\n\n" + text,
-            reply_markup=reply_kb
-        )
-        sent_any = True
+        await outbox.send(SendMessage(
+            chat_id=to_id,
+            text=t(to_lang, "anon_text", text=html.escape(text)),
+            reply_markup=kb_reply(message.from_user.id, to_lang)
+        ), PRIO_RELAY)
         log_text = text
 
-    # Фото
-    elif message.photo:
-        caption = (message.caption or "").strip()
-        await bot.send_photo(
-            to_id,
-            photo=message.photo[-1].file_id,
-            caption=("📩 Вам пришло анонимное фото.\n\n" + caption) if caption else "📩 Вам пришло анонимное фото.",
-            reply_markup=reply_kb
-        )
-        sent_any = True
-        log_text = "[photo] " + (caption if caption else "")
-
-    # Стикер
-    elif message.sticker:
-        await bot.send_message(to_id, "📩 Вам пришёл анонимный стикер:", reply_markup=reply_kb)
-        await bot.send_sticker(to_id, message.sticker.file_id)
-        sent_any = True
-        log_text = "[sticker]"
-
-    # Документ/файл
-    elif message.document:
-        caption = (message.caption or "").strip()
-        await bot.send_document(
-            to_id,
-            document=message.document.file_id,
-            caption=("📩 Вам пришёл анонимный файл.\n\n" + caption) if caption else "📩 Вам пришёл анонимный файл.",
-            reply_markup=reply_kb
-        )
-        sent_any = True
-        log_text = "[document] " + (caption if caption else "")
-
-    # (не просил, но оставил)
-    elif message.video:
+    # Фото / файл / видео / голосовое / стикер / ... — одним copyMessage
+    elif message.content_type in RELAY_TYPES:
+        header, tag = RELAY_TYPES[message.content_type]
         caption = (message.caption or "").strip()
-        await bot.send_video(
-            to_id,
-            video=message.video.file_id,
-            caption=("📩 Вам пришло анонимное видео.\n\n" + caption) if caption else "📩 Вам пришло анонимное видео.",
-            reply_markup=reply_kb
-        )
-        sent_any = True
-        log_text = "[video] " + (caption if caption else "")
-
-    elif message.voice:
-        await bot.send_voice(
-            to_id,
-            voice=message.voice.file_id,
-            caption="📩 Вам пришло анонимное голосовое.",
-            reply_markup=reply_kb
-        )
-        sent_any = True
-        log_text = "[voice]"
+        await outbox.send(CopyMessage(
+            chat_id=to_id,
+            from_chat_id=message.chat.id,
+            message_id=message.message_id,
+            caption=with_header(t(to_lang, header), caption) if header else None,
+            reply_markup=kb_reply(message.from_user.id, to_lang)
+        ), PRIO_RELAY)
+        log_text = (tag + " " + caption) if header else tag
 
-    if not sent_any:
-        await message.answer("Я могу отправлять текст, фото, стикеры и файлы.")
+    else:
+        await outbox.send(message.answer(t(lang, "unsupported")))
         return
 
-    inc_msg(to_id)
+    await after_relay(message.from_user.id, message.chat.id, to_id, log_text)
+
+
+async def on_startup():
+    store.open()
+    await metrics_server.start()
+    await init_db()
+    await pending.load()
+    pending.start()
+    write_behind.start()
+    retention.start()
+    maintenance.start()
+    outbox.start()
+    admin_digest.start()
+    await identity.refresh()
+    identity.start()
+    executor.start()
+    await broadcaster.resume()
+
+
+async def on_shutdown():
+    await executor.stop()
+    await albums.stop()
+    await broadcaster.stop()
+    await identity.stop()
+    await pending.stop()
+    await retention.stop()
+    await maintenance.stop()
+    await admin_digest.stop()
+    await outbox.stop()
+    await write_behind.stop()
+    store.close()
+    await metrics_server.stop()
 
-    log_message(message.from_user.id, to_id, log_text)
-    await send_admin_log(message.from_user.id, to_id, log_text)
 
-    await message.answer("✅ Отправлено!", reply_markup=kb_write_more())
+# =========================
+# WEBHOOK
+# =========================
+async def on_webhook_startup(bot: Bot):
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
 
-    # чтобы можно было писать дальше
-    set_pending(message.from_user.id, to_id)
+
+async def on_webhook_shutdown(bot: Bot):
+    # по умолчанию webhook не снимаем: при деплое с перекрытием новый процесс уже поставил свой,
+    # и старый снял бы его при выходе
+    if WEBHOOK_DELETE_ON_SHUTDOWN:
+        await bot.delete_webhook()
+
+
+def build_webhook_app() -> web.Application:
+    app = web.Application()
+    # порядок важен: сначала shutdown диспетчера (он ещё шлёт через bot), потом закрытие сессии
+    setup_application(app, dp, bot=bot)
+    # ответ 200 уходит сразу после постановки апдейта в очередь ChatExecutor
+    # (обработка идёт в его воркерах), а при переполнении очереди Telegram ждёт — это backpressure
+    SimpleRequestHandler(dp, bot, handle_in_background=False, secret_token=WEBHOOK_SECRET).register(
+        app, path=WEBHOOK_PATH
+    )
+    return app
+
+
+async def run_webhook():
+    dp.startup.register(on_webhook_startup)
+    dp.shutdown.register(on_webhook_shutdown)
+    runner = web.AppRunner(build_webhook_app())
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    log.info("webhook mode: listening on %s:%s%s", WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
 
 
 async def main():
-    init_db()
-    await dp.start_polling(bot)
+    logging.basicConfig(level=logging.INFO)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    if UPDATE_MODE == "webhook":
+        await run_webhook()
+    else:
+        # апдейты и так уходят в ChatExecutor; handle_as_tasks=False — чтобы polling ждал места в очереди
+        await dp.start_polling(bot, handle_as_tasks=False)
 
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
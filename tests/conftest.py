@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# main.py читает настройки при импорте и без BOT_TOKEN не загружается
+os.environ.setdefault("BOT_TOKEN", "123456:test-token")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="bot-tests-"), "test.sqlite3"))
+os.environ.setdefault("METRICS_PORT", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,52 @@
+import pytest
+
+from main import CodeCodec
+
+MAX_ID = (1 << 64) - 1
+
+
+@pytest.fixture
+def codec():
+    c = CodeCodec()
+    c.set_key(b"test-secret")
+    return c
+
+
+def test_round_trip(codec):
+    for user_id in (0, 1, 7489815425, 1 << 32, (1 << 32) - 1, MAX_ID):
+        code = codec.encode(user_id)
+        assert len(code) == CodeCodec.LENGTH
+        assert codec.decode(code) == user_id
+
+
+def test_codes_are_unique(codec):
+    ids = [0, MAX_ID, *range(1, 20_000), *range(MAX_ID - 20_000, MAX_ID)]
+    codes = {codec.encode(user_id) for user_id in ids}
+    assert len(codes) == len(ids)
+    assert all(len(code) == CodeCodec.LENGTH and code.isalnum() for code in codes)
+
+
+def test_key_changes_codes(codec):
+    other = CodeCodec()
+    other.set_key(b"another-secret")
+    assert codec.encode(12345) != other.encode(12345)
+
+
+@pytest.mark.parametrize("code", [
+    "",
+    "abc",
+    "0" * (CodeCodec.LENGTH + 1),
+    "abc-def_ghij1",
+    "abcdefghijkl ",
+    "абвгдежзийклм",
+    "ａｂｃｄｅｆｇｈｉｊｋｌｍ",
+    "z" * CodeCodec.LENGTH,  # больше 2**64
+])
+def test_decode_rejects_garbage(codec, code):
+    assert codec.decode(code) is None
+
+
+@pytest.mark.parametrize("user_id", [-1, 1 << 64])
+def test_encode_rejects_out_of_range(codec, user_id):
+    with pytest.raises(ValueError):
+        codec.encode(user_id)
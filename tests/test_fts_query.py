@@ -0,0 +1,47 @@
+import sqlite3
+
+import pytest
+
+from main import fts_query
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("hello", '"hello"'),
+    ("hello world", '"hello" "world"'),
+    ('"hello world" again', '"hello world" "again"'),
+    ("hel*", '"hel"*'),
+    ('say"hi', '"say""hi"'),
+    ("a AND b OR NOT c", '"a" "AND" "b" "OR" "NOT" "c"'),
+    ("( ) : ^ - +", '"(" ")" ":" "^" "-" "+"'),
+    ("NEAR(a b)", '"NEAR(a" "b)"'),
+    ("* ** \"\" \"  \"", ""),
+    ("", ""),
+])
+def test_fts_query_escaping(text, expected):
+    assert fts_query(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    'a AND', "OR", "NOT x", "(", '"unclosed', "col:value", "^start", "-minus", "x*y*", 'he said "hi', "NEAR(a b, 2)",
+])
+def test_fts_query_is_valid_fts5(text):
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE VIRTUAL TABLE t USING fts5(text)")
+    con.execute("INSERT INTO t VALUES ('he said hi to a start value')")
+    match = fts_query(text)
+    if match:
+        con.execute("SELECT rowid FROM t WHERE t MATCH ?", (match,)).fetchall()
+
+
+@pytest.mark.parametrize("text, found", [
+    ("sa*", True),
+    ('"said hi"', True),
+    ('"hi said"', False),
+    ("said OR nothing", False),  # OR — просто слово, а не оператор
+])
+def test_fts_query_matches(text, found):
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE VIRTUAL TABLE t USING fts5(text)")
+    con.execute("INSERT INTO t VALUES ('he said hi to a start value')")
+    rows = con.execute("SELECT rowid FROM t WHERE t MATCH ?", (fts_query(text),)).fetchall()
+    assert bool(rows) is found